@@ -4,7 +4,11 @@ from sys import exit
 
 # local imports
 from . import palera1n
+from . import profiling
 from . import utils
+from . import watchdog
+from . import logger
+from .exceptions import Palera1nError
 
 
 def main(argv=None, in_package=None) -> None:
@@ -14,7 +18,8 @@ def main(argv=None, in_package=None) -> None:
     in_package = False if in_package is None else in_package
     
     parser = ArgumentParser()
-    parser.add_argument('subcommand', nargs='?', help='subcommands: dfuhelper, clean')
+    parser.add_argument('subcommand', nargs='?', help='subcommands: dfuhelper, clean, scan, uploadbench, history, pack')
+    parser.add_argument('paths', nargs='*', help='files to compress with the pack subcommand')
     
     parser.add_argument('-d', '--debug', action='store_true',
                         help='shows debug info, useful for testing')
@@ -28,15 +33,41 @@ def main(argv=None, in_package=None) -> None:
                         help='disables anonymous analytics')
     parser.add_argument('-H', '--disable-hash-checking', action='store_true',
                         help='disables hash checking for binaries')
+    parser.add_argument('-n', '--non-interactive', action='store_true',
+                        help='start the DFU sequence without waiting for enter, for automated button rigs')
+    parser.add_argument('--dfu-hook', metavar='CMD',
+                        help='command to run at each DFU phase, called with the phase and device family')
+    parser.add_argument('--deadline', action='append', type=watchdog.parse_deadline, metavar='STAGE=SECONDS',
+                        help='override how long a stage may take, 0 for no deadline (can be repeated)')
+    parser.add_argument('--retries', type=int, default=2, metavar='N',
+                        help='times to recover and retry a stage that timed out (defaults to 2)')
+    parser.add_argument('--simulate', action='store_true',
+                        help='run uploadbench against a simulated Pongo device')
+    parser.add_argument('--json', action='store_true',
+                        help='print scan results as JSON')
+    parser.add_argument('--export', choices=('csv', 'json'),
+                        help='export run history instead of showing a report')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='file to export run history to (defaults to stdout)')
+    parser.add_argument('--since', type=float, metavar='HOURS',
+                        help='only include runs from the last HOURS hours in run history')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile and tracemalloc, reports go in the data directory')
     parser.add_argument('-v', '--version', action='version', version=f'palera1n v{utils.get_version()}',
                         help='show current version and exit')
     args = parser.parse_args()
 
     pr = palera1n.palera1n(in_package, args)
     try:
-        pr.main()
+        if args.profile:
+            profiling.run(pr.main, utils.get_storage_dir())
+        else:
+            pr.main()
     except KeyboardInterrupt:
         exit(1)
+    except Palera1nError as err:
+        logger.error(err)
+        exit(1)
 
 
 if __name__ == '__main__':
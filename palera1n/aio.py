@@ -0,0 +1,251 @@
+# module imports
+from argparse import Namespace
+from asyncio import Lock, TimeoutError as AsyncTimeoutError, create_subprocess_exec, get_running_loop, sleep
+from asyncio import wait_for as wait_for_coro
+from asyncio.subprocess import PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from inspect import isawaitable
+from pathlib import Path
+from pymobiledevice3.irecv import IRecv
+from time import monotonic
+from typing import Any, Awaitable, Callable, Union
+from weakref import WeakKeyDictionary
+from usb.util import dispose_resources
+
+# local imports
+from . import dfu
+from . import utils
+from . import logger
+from .exceptions import Checkra1nError, DeviceTimeoutError, MultipleDevicesError
+from .jb import Jailbreak, pongo_find
+
+
+Prompt = Callable[[str], Union[Any, Awaitable[Any]]]
+
+_max_workers = 4
+_executor = None
+# asyncio locks belong to one event loop, so each loop gets its own
+_checkra1n_locks = WeakKeyDictionary()
+
+
+def set_max_workers(count: int) -> None:
+    """Set how many blocking calls may run at once.
+
+    Must be called before the first blocking call is made.
+
+    :param int count: Amount of worker threads
+    """
+
+    global _max_workers
+    _max_workers = count
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the executor blocking USB I/O and shell-outs are offloaded to.
+
+    :return: Executor
+    :rtype: ThreadPoolExecutor
+    """
+
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='palera1n')
+
+    return _executor
+
+
+async def offload(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in the executor.
+
+    :param Callable func: Function to run
+    :return: Whatever the function returns
+    """
+
+    return await get_running_loop().run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+async def _run_in_thread(func: Callable, *args, **kwargs) -> Any:
+    # For long blocking calls, so they don't hold one of the shared executor's workers
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='palera1n-long')
+    try:
+        return await get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def _call(callback: Prompt, message: str) -> Any:
+    result = callback(message)
+    if isawaitable(result):
+        result = await result
+
+    return result
+
+
+async def detect(selector: str = None) -> str:
+    """Find what state the device is in.
+
+    :param str selector: Port key or ECID of the device, see utils.matches_device (defaults to None)
+    :return: Device state
+    :rtype: str
+    :raises MultipleDevicesError: If more than one device is attached and no selector was given
+    """
+
+    return await offload(utils.get_device_mode, selector)
+
+
+async def wait_for(mode: str, interval: float = 1.0, timeout: float = None, selector: str = None) -> None:
+    """Wait for device to go into a state.
+
+    :param str mode: State we are waiting for
+    :param float interval: Seconds between checks (defaults to 1.0)
+    :param float timeout: Seconds to wait before giving up, None waits forever (defaults to None)
+    :param str selector: Port key or ECID of the device (defaults to None)
+    :raises DeviceTimeoutError: If the timeout passed
+    """
+
+    deadline = None if timeout is None else monotonic() + timeout
+    while await detect(selector) != mode:
+        if deadline is not None and monotonic() >= deadline:
+            raise DeviceTimeoutError(f'Device did not enter {mode} mode within {timeout} seconds')
+        await sleep(interval)
+
+
+def _get_checkra1n_lock() -> Lock:
+    loop = get_running_loop()
+    lock = _checkra1n_locks.get(loop)
+    if lock is None:
+        lock = _checkra1n_locks[loop] = Lock()
+
+    return lock
+
+
+async def run_checkra1n(data_dir: Path, args: Namespace = None, timeout: float = None, selector: str = None,
+                        **kwargs) -> str:
+    """Run checkra1n without blocking the event loop.
+
+    Takes the same keyword arguments as Jailbreak.checkra1n_command.
+
+    checkra1n can't be told which device to use and exploits the first one it
+    finds in DFU, so runs in the same event loop are serialized, and with a
+    selector the run is refused while any other device is in DFU.
+
+    :param Path data_dir: Data directory containing checkra1n
+    :param Namespace args: Args object (defaults to None)
+    :param float timeout: Seconds before checkra1n is killed, None waits forever (defaults to None)
+    :param str selector: Port key or ECID of the device checkra1n is meant for (defaults to None)
+    :return: Output of checkra1n
+    :rtype: str
+    :raises Checkra1nError: If checkra1n exited with an error
+    :raises DeviceTimeoutError: If checkra1n was killed after the timeout
+    :raises MultipleDevicesError: If another device than the selected one is in DFU
+    """
+
+    args = args or Namespace(debug=False)
+    cmd = Jailbreak(data_dir, args).checkra1n_command(**kwargs)
+
+    async with _get_checkra1n_lock():
+        if selector is not None:
+            others = [utils.port_key(dev) for dev, mode in await offload(utils.find_devices)
+                      if mode == 'dfu' and not utils.matches_device(dev, selector)]
+            if others:
+                raise MultipleDevicesError(f'checkra1n can\'t target {selector} while other devices are in DFU: '
+                                           f'{", ".join(others)}')
+
+        logger.debug(f'Running command: {" ".join(cmd)}', args.debug)
+        proc = await create_subprocess_exec(*cmd, stdout=PIPE, stderr=STDOUT)
+        try:
+            output, _ = await wait_for_coro(proc.communicate(), timeout)
+        except AsyncTimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise DeviceTimeoutError(f'checkra1n did not finish within {timeout:g} seconds')
+    output = output.decode(errors='replace').strip()
+
+    if proc.returncode != 0:
+        raise Checkra1nError(f'Failed to run checkra1n: {output}')
+
+    return output
+
+
+async def guide_to_dfu(cpid: str, product: str, irecv: IRecv, prompt: Prompt, **kwargs) -> None:
+    """Guide the user to enter DFU mode.
+
+    Takes the same keyword arguments as dfu.DFUHelper, except for prompt and
+    interactive. Pass selector when driving more than one device, otherwise
+    any device entering DFU counts as success. The button sequence runs on a
+    thread of its own instead of the shared executor.
+
+    :param str cpid: CPID of the device
+    :param str product: Device product number
+    :param IRecv irecv: IRecv object to send the device into recovery
+    :param Prompt prompt: Called, and awaited if needed, when the operator has to get ready
+    :raises DFUError: If the device did not enter DFU mode
+    """
+
+    await _call(prompt, 'Press enter when you\'re ready to enter DFU mode.')
+    await _run_in_thread(dfu.guide_to_dfu, cpid, product, irecv, interactive=False, **kwargs)
+
+
+class PongoSession:
+    """Async connection to a device in Pongo.
+
+    Blocking USB transfers run in the shared executor, one at a time per session.
+    Pass a selector to drive one of several devices::
+
+        async with PongoSession(data_dir, selector='1-2.3') as pongo:
+            await pongo.send_file(kpf, modload=True)
+            await pongo.send_cmd('bootx')
+    """
+
+    def __init__(self, data_dir: Path, args: Namespace = None, settle: float = 1.0, selector: str = None) -> None:
+        self.args = args or Namespace(debug=False)
+        self.jb = Jailbreak(data_dir, self.args)
+        self.settle = settle
+        self.selector = selector
+        self.dev = None
+        self._lock = Lock()
+
+    async def __aenter__(self) -> 'PongoSession':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        """Find and configure the device.
+
+        :raises DeviceNotFoundError: If no device, or not the selected one, is in Pongo
+        """
+
+        self.dev = await offload(pongo_find, self.selector)
+        await offload(self.dev.set_configuration)
+
+    async def close(self) -> None:
+        """Release the USB handle."""
+
+        if self.dev is not None:
+            await offload(dispose_resources, self.dev)
+            self.dev = None
+
+    async def send_cmd(self, cmd: str) -> None:
+        """Run a command on device using Pongo.
+
+        :param str cmd: Command to run
+        """
+
+        async with self._lock:
+            await offload(self.jb.pongo_write_cmd, self.dev, cmd)
+            await sleep(self.settle)
+
+    async def send_file(self, file: Path, modload: bool = False) -> None:
+        """Send a file to device using Pongo.
+
+        :param Path file: File to send
+        :param bool modload: Defaults to False
+        """
+
+        async with self._lock:
+            await offload(self.jb.pongo_write_file, self.dev, file, modload)
+            await sleep(self.settle)
@@ -0,0 +1,300 @@
+# module imports
+from hashlib import sha256
+from os import replace
+from pathlib import Path
+from queue import Queue
+from struct import Struct, error as StructError
+from threading import Thread
+from typing import BinaryIO, Union
+from zlib import compress, crc32, decompress, error as ZlibError
+
+# local imports
+from .exceptions import ArtifactError
+
+
+# Container layout:
+#   header: magic, version, block size
+#   blocks: each block of the original file, zlib compressed on its own
+#   index:  offset, compressed size and crc32 of every block
+#   footer: index offset, block count, original size, magic
+MAGIC = b'P1AR'
+VERSION = 1
+EXTENSION = '.p1a'
+BLOCK_SIZE = 1024 * 1024
+
+HEADER = Struct('<4sB3xI')
+ENTRY = Struct('<QII')
+FOOTER = Struct('<QIQ4s')
+
+
+def is_compressed(path: Path) -> bool:
+    """Check if a path is a compressed artifact.
+
+    :param Path path: Path to check
+    :return: True if it has the compressed artifact extension
+    :rtype: bool
+    """
+
+    return Path(path).suffix == EXTENSION
+
+
+def pack(src: Path, dest: Path = None, block_size: int = BLOCK_SIZE, level: int = 9) -> Path:
+    """Compress a file into a seekable artifact container.
+
+    :param Path src: File to compress
+    :param Path dest: Where to write the container (defaults to src with .p1a appended)
+    :param int block_size: Uncompressed size of each block (defaults to 1 MiB)
+    :param int level: zlib compression level (defaults to 9)
+    :return: Path to the container
+    :rtype: Path
+    """
+
+    src = Path(src)
+    dest = Path(dest) if dest is not None else src.with_name(src.name + EXTENSION)
+    tmp = dest.with_name(dest.name + '.tmp')
+
+    index = []
+    size = 0
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, VERSION, block_size))
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+
+            data = compress(block, level)
+            index.append((fout.tell(), len(data), crc32(block)))
+            fout.write(data)
+            size += len(block)
+
+        index_offset = fout.tell()
+        for entry in index:
+            fout.write(ENTRY.pack(*entry))
+        fout.write(FOOTER.pack(index_offset, len(index), size, MAGIC))
+
+    replace(tmp, dest)
+    return dest
+
+
+class ArtifactReader:
+    """Read-only, seekable file object over a compressed artifact.
+
+    Only the block containing the current position is kept decompressed.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.f = open(self.path, 'rb')
+
+        try:
+            magic, version, self.block_size = HEADER.unpack(self.f.read(HEADER.size))
+            self.f.seek(-FOOTER.size, 2)
+            index_offset, count, self.size, end_magic = FOOTER.unpack(self.f.read(FOOTER.size))
+            if magic != MAGIC or end_magic != MAGIC or version != VERSION:
+                raise ArtifactError(f'{self.path} is not a palera1n artifact')
+
+            self.f.seek(index_offset)
+            self.index = [ENTRY.unpack(self.f.read(ENTRY.size)) for _ in range(count)]
+        except (StructError, OSError) as err:
+            self.f.close()
+            raise ArtifactError(f'{self.path} is truncated or not a palera1n artifact: {err}')
+        except ArtifactError:
+            self.f.close()
+            raise
+
+        self.pos = 0
+        self._block = None
+        self._data = b''
+
+    @property
+    def identity(self) -> str:
+        """Digest of the index, which holds the checksum of every block, and the size.
+
+        Two artifacts only share an identity if they hold the same data.
+        """
+
+        digest = sha256(FOOTER.pack(0, len(self.index), self.size, MAGIC))
+        for entry in self.index:
+            digest.update(ENTRY.pack(*entry))
+
+        return digest.hexdigest()[:16]
+
+    def __enter__(self) -> 'ArtifactReader':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.f.close()
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        return self.pos
+
+    def _load(self, block: int) -> bytes:
+        if block != self._block:
+            offset, csize, checksum = self.index[block]
+            self.f.seek(offset)
+            try:
+                data = decompress(self.f.read(csize))
+            except ZlibError as err:
+                raise ArtifactError(f'{self.path} is corrupted: {err}')
+            if crc32(data) != checksum:
+                raise ArtifactError(f'{self.path} is corrupted: checksum mismatch in block {block}')
+
+            self._block, self._data = block, data
+
+        return self._data
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size - self.pos
+
+        out = []
+        while n > 0 and self.pos < self.size:
+            block, start = divmod(self.pos, self.block_size)
+            data = self._load(block)[start:start + n]
+            out.append(data)
+            self.pos += len(data)
+            n -= len(data)
+
+        return b''.join(out)
+
+
+class PrefetchReader:
+    """Reads a file object ahead on a background thread into a bounded queue,
+    so reading and decompressing overlap with whatever consumes the data.
+    """
+
+    def __init__(self, f: BinaryIO, size: int, chunk_size: int = BLOCK_SIZE, depth: int = 4) -> None:
+        self.f = f
+        self.size = size
+        self.chunk_size = chunk_size
+        self.queue = Queue(maxsize=depth)
+        self.buffer = b''
+        self.done = False
+        self.closed = False
+        self.thread = Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'PrefetchReader':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _fill(self) -> None:
+        try:
+            while not self.closed:
+                data = self.f.read(self.chunk_size)
+                self.queue.put(data)
+                if not data:
+                    return
+        except Exception as err:
+            self.queue.put(err)
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size
+
+        while len(self.buffer) < n and not self.done:
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self.done = True
+            self.buffer += data
+
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def close(self) -> None:
+        self.closed = True
+        # Unblock the reader thread if it's waiting for space in the queue
+        while self.thread.is_alive():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.thread.join(0.01)
+        self.f.close()
+
+
+def open_artifact(path: Path, chunk_size: int = BLOCK_SIZE) -> PrefetchReader:
+    """Open a raw or compressed artifact for streaming.
+
+    :param Path path: Path to the artifact
+    :param int chunk_size: Size of the pieces read ahead (defaults to 1 MiB)
+    :return: Reader with the uncompressed size in its size attribute
+    :rtype: PrefetchReader
+    """
+
+    if is_compressed(path):
+        f = ArtifactReader(path)
+        size = f.size
+    else:
+        f = open(path, 'rb')
+        size = Path(path).stat().st_size
+
+    return PrefetchReader(f, size, chunk_size)
+
+
+def materialize(path: Path, cache_dir: Path) -> Path:
+    """Get a path to the uncompressed artifact, for tools that need a real file.
+
+    Extracted copies are named after the artifact's identity, so a different
+    release of the same file is never mistaken for a cached one. Copies of
+    other releases are removed.
+
+    :param Path path: Path to the artifact
+    :param Path cache_dir: Directory to extract compressed artifacts into
+    :return: path itself if it isn't compressed, otherwise the extracted copy
+    :rtype: Path
+    """
+
+    path = Path(path)
+    if not is_compressed(path):
+        return path
+
+    cache_dir = Path(cache_dir)
+    with ArtifactReader(path) as fin:
+        dest = cache_dir / f'{fin.identity}-{path.stem}'
+        if dest.exists():
+            return dest
+
+        cache_dir.mkdir(exist_ok=True, parents=True)
+        for stale in cache_dir.glob(f'*-{path.stem}'):
+            stale.unlink()
+
+        tmp = dest.with_name(dest.name + '.tmp')
+        with open(tmp, 'wb') as fout:
+            while True:
+                data = fin.read(fin.block_size)
+                if not data:
+                    break
+                fout.write(data)
+
+    replace(tmp, dest)
+    return dest
+
+
+def resolve(directory: Path, name: str) -> Union[Path, None]:
+    """Find an artifact in a directory, raw or compressed.
+
+    :param Path directory: Directory to look in
+    :param str name: Name of the uncompressed artifact
+    :return: Path to the artifact, None if neither form exists
+    :rtype: Union[Path, None]
+    """
+
+    for candidate in (Path(directory) / name, Path(directory) / (name + EXTENSION)):
+        if candidate.exists():
+            return candidate
+
+    return None
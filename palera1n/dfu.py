@@ -0,0 +1,270 @@
+# module imports
+from json import load
+from math import ceil
+from pathlib import Path
+from pymobiledevice3.irecv import IRecv
+import subprocess
+from shlex import split
+from sys import stdout
+from threading import Event, Thread
+from time import monotonic
+from typing import Callable, Union
+from usb.core import NoBackendError, USBError, find
+from usb.util import dispose_resources
+
+# local imports
+from . import utils
+from . import logger
+from .exceptions import DFUError
+from .logger import colors
+
+
+# Seconds spent in each phase, per device family. The hold countdown starts
+# at hold, but the reset is sent and the release phase starts after reset
+# seconds, like the original button sequence did.
+TIMINGS = {
+    'home': {'ready': 3, 'hold': 4, 'reset': 3, 'release': 10},
+    'volume': {'ready': 3, 'hold': 4, 'reset': 3, 'release': 10},
+}
+
+MESSAGES = {
+    'home': {
+        'ready': 'Get ready',
+        'hold': 'Hold home + power button',
+        'release': 'Release power button, but keep holding home button',
+    },
+    'volume': {
+        'ready': 'Get ready',
+        'hold': 'Hold volume down + side button',
+        'release': 'Release side button, but keep holding volume down',
+    },
+}
+
+PHASES = ('ready', 'hold', 'release')
+TIMING_KEYS = PHASES + ('reset',)
+
+
+def family(cpid: str, product: str) -> str:
+    """Get the button family of a device.
+
+    :param str cpid: CPID of the device
+    :param str product: Device product number
+    :return: 'volume' for devices without a home button, otherwise 'home'
+    :rtype: str
+    """
+
+    if cpid.startswith('0x801') and not product.startswith('iPad'):
+        return 'volume'
+    else:
+        return 'home'
+
+
+def load_timings(data_dir: Path) -> dict:
+    """Get DFU timings, with overrides from dfu.json in the data dir applied.
+
+    dfu.json looks like {"volume": {"hold": 5, "reset": 4}}.
+
+    :param Path data_dir: Data directory
+    :return: Timings per family
+    :rtype: dict
+    """
+
+    timings = {name: dict(phases) for name, phases in TIMINGS.items()}
+    path = Path(data_dir) / 'dfu.json'
+    if not path.exists():
+        return timings
+
+    try:
+        with open(path, 'r') as f:
+            overrides = load(f)
+    except (OSError, ValueError) as err:
+        logger.error(f'Ignoring {path}: {err}')
+        return timings
+
+    for name, phases in overrides.items():
+        if name in timings:
+            timings[name].update({phase: float(seconds) for phase, seconds in phases.items() if phase in TIMING_KEYS})
+
+    return timings
+
+
+def dfu_present(selector: str = None) -> bool:
+    """Check if a device in DFU mode is attached.
+
+    Asks libusb directly. Without a selector, falls back to get_device_mode if
+    there is no backend; selecting a device needs libusb.
+
+    :param str selector: Port key or ECID of the device, None accepts any device (defaults to None)
+    :return: True if the device is in DFU mode
+    :rtype: bool
+    """
+
+    if selector is not None:
+        try:
+            devices = utils.find_devices(selector)
+        except USBError:
+            return False
+        for dev, _ in devices:
+            dispose_resources(dev)
+
+        return any(mode == 'dfu' for _, mode in devices)
+
+    try:
+        return find(idVendor=0x05ac, idProduct=0x1227) is not None
+    except (NoBackendError, USBError):
+        return utils.get_device_mode() == 'dfu'
+
+
+def run_hook(hook: str, event: str, family_name: str) -> None:
+    """Run the button rig hook for an event without waiting for it.
+
+    :param str hook: Command to run, the event and family are appended as arguments
+    :param str event: ready, hold, release or done
+    :param str family_name: Device family
+    """
+
+    try:
+        subprocess.Popen(split(hook) + [event, family_name])
+    except OSError as err:
+        logger.error(f'Failed to run DFU hook: {err}')
+
+
+class LineRenderer:
+    """Draws a status line, rewriting the whole line in one write."""
+
+    def __init__(self, color: str = colors['yellow']) -> None:
+        self.prefix = color + colors['bold'] + '[*] ' + colors['reset'] + color
+        self.live = stdout.isatty()
+        self.last = None
+
+    def draw(self, message: str, remaining: int) -> None:
+        """Draw a message with a countdown.
+
+        :param str message: Message to show
+        :param int remaining: Seconds left in the countdown
+        """
+
+        if self.live:
+            line = f'{message} ({remaining})'
+            if line != self.last:
+                stdout.write('\r' + self.prefix + line + colors['reset'] + '\033[K')
+                stdout.flush()
+        else:
+            # Not a terminal, so only log when the message changes
+            line = message
+            if line != self.last:
+                stdout.write(self.prefix + line + colors['reset'] + '\n')
+                stdout.flush()
+
+        self.last = line
+
+    def clear(self) -> None:
+        """Remove the status line."""
+
+        if self.live and self.last is not None:
+            stdout.write('\r\033[K')
+            stdout.flush()
+        self.last = None
+
+
+class DFUHelper:
+    """Times the button sequence to get a device from recovery into DFU mode.
+
+    A background thread watches for the device in DFU mode during every
+    phase, so success is reported as soon as it shows up. Pass a selector
+    when more than one device is attached, otherwise any device in DFU counts.
+    """
+
+    def __init__(self, cpid: str, product: str, irecv: IRecv, timings: dict = None,
+                 prompt: Callable[[str], None] = logger.ask, interactive: bool = True,
+                 hook: Union[str, None] = None, poll_interval: float = 0.1, selector: str = None) -> None:
+        self.family = family(cpid, product)
+        self.timings = (timings or TIMINGS)[self.family]
+        self.irecv = irecv
+        self.prompt = prompt
+        self.interactive = interactive
+        self.hook = hook
+        self.poll_interval = poll_interval
+        self.selector = selector
+        self.renderer = LineRenderer()
+        self.found = Event()
+        self.stop = Event()
+
+    def _watch(self) -> None:
+        while not self.stop.is_set():
+            if dfu_present(self.selector):
+                self.found.set()
+                return
+            self.stop.wait(self.poll_interval)
+
+    def _phase(self, phase: str) -> bool:
+        if self.hook is not None:
+            run_hook(self.hook, phase, self.family)
+
+        message = MESSAGES[self.family][phase]
+        start = monotonic()
+        deadline = start + self.timings[phase]
+        # The hold phase is cut short when it's time to send the reset
+        end = start + min(self.timings.get('reset', self.timings[phase]), self.timings[phase]) if phase == 'hold' else deadline
+        while True:
+            remaining = deadline - monotonic()
+            if monotonic() >= end:
+                return False
+
+            self.renderer.draw(message, ceil(remaining))
+            # Sleep until the countdown ticks over, waking up early if DFU shows up
+            if self.found.wait(min(remaining - ceil(remaining) + 1, end - monotonic())):
+                return True
+
+    def run(self) -> None:
+        """Guide the device into DFU mode.
+
+        :raises DFUError: If the device did not enter DFU mode
+        """
+
+        watcher = Thread(target=self._watch, daemon=True)
+        watcher.start()
+
+        try:
+            if self.interactive:
+                self.prompt('Press enter when you\'re ready to enter DFU mode.')
+
+            entered = self.found.is_set()
+            for phase in PHASES:
+                if entered:
+                    break
+
+                if phase == 'release':
+                    try:
+                        self.irecv.send_command('reset')
+                    except:
+                        pass
+
+                entered = self._phase(phase)
+
+            self.renderer.clear()
+            if not entered:
+                entered = dfu_present(self.selector)
+        finally:
+            self.stop.set()
+            if self.hook is not None:
+                run_hook(self.hook, 'done', self.family)
+
+        if not entered:
+            raise DFUError('Failed to enter DFU mode. Try running the script again.')
+
+        logger.log('Successfully entered DFU mode.')
+
+
+def guide_to_dfu(cpid: str, product: str, irecv: IRecv, **kwargs) -> None:
+    """Guide the user to enter DFU mode
+
+    Takes the same keyword arguments as DFUHelper.
+
+    :param str cpid: CPID of the device
+    :param str product: Device product number
+    :param IRecv irecv: IRecv object to send the device into recovery
+    :raises DFUError: If the device did not enter DFU mode
+    """
+
+    DFUHelper(cpid, product, irecv, **kwargs).run()
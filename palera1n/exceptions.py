@@ -0,0 +1,41 @@
+class Palera1nError(Exception):
+    """Base class for errors raised by palera1n."""
+
+
+class DeviceNotFoundError(Palera1nError):
+    """The device could not be found."""
+
+
+class MultipleDevicesError(Palera1nError):
+    """More than one device is attached."""
+
+
+class CommandError(Palera1nError):
+    """An external command failed."""
+
+
+class Checkra1nError(CommandError):
+    """checkra1n could not be downloaded or failed to run."""
+
+
+class DFUError(Palera1nError):
+    """The device did not enter DFU mode."""
+
+
+class DeviceTimeoutError(Palera1nError):
+    """The device did not reach the expected state in time."""
+
+
+class StageTimeoutError(DeviceTimeoutError):
+    """A stage of the run went past its deadline."""
+
+    def __init__(self, stage: str, seconds: float, reason: str = None) -> None:
+        self.stage = stage
+        self.seconds = seconds
+        self.reason = reason
+        message = f'{stage} timed out' if seconds is None else f'{stage} did not finish within {seconds:g} seconds'
+        super().__init__(message + (f': {reason}' if reason else ''))
+
+
+class ArtifactError(Palera1nError):
+    """An artifact is missing or corrupted."""
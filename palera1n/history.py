@@ -0,0 +1,375 @@
+# module imports
+from argparse import Namespace
+from contextlib import contextmanager
+from csv import DictWriter
+from json import dump
+from math import ceil
+from pathlib import Path
+from sqlite3 import connect, Row
+from sys import stdout
+from time import monotonic, time
+from typing import TextIO, Union
+
+# local imports
+from .logger import colors
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    ecid TEXT,
+    product_type TEXT,
+    chip_id TEXT,
+    port TEXT,
+    subcommand TEXT,
+    safe_mode INTEGER NOT NULL DEFAULT 0,
+    restore_rootfs INTEGER NOT NULL DEFAULT 0,
+    serial INTEGER NOT NULL DEFAULT 0,
+    outcome TEXT NOT NULL DEFAULT 'running',
+    failed_stage TEXT,
+    error TEXT,
+    retries INTEGER NOT NULL DEFAULT 0,
+    bytes_uploaded INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    ok INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs(started_at);
+CREATE INDEX IF NOT EXISTS runs_outcome ON runs(outcome, started_at);
+CREATE INDEX IF NOT EXISTS runs_ecid ON runs(ecid);
+CREATE INDEX IF NOT EXISTS runs_product_type ON runs(product_type);
+CREATE INDEX IF NOT EXISTS stages_run_id ON stages(run_id);
+CREATE INDEX IF NOT EXISTS stages_name_duration ON stages(name, duration);
+'''
+
+# Bump SCHEMA_VERSION and add the statements that upgrade an older database
+# to MIGRATIONS when changing SCHEMA. Databases from before user_version was
+# set are version 1.
+SCHEMA_VERSION = 2
+MIGRATIONS = {
+    2: ('ALTER TABLE stages ADD COLUMN error TEXT',),
+}
+
+# Run kinds the report can be limited to, as a WHERE clause on runs. Only boots
+# count towards throughput, dfuhelper runs stop once the device is in DFU.
+KINDS = {
+    'boot': 'runs.subcommand IS NULL',
+    'dfuhelper': "runs.subcommand = 'dfuhelper'",
+    None: '1',
+}
+
+RUN_FIELDS = ('id', 'started_at', 'finished_at', 'ecid', 'product_type', 'chip_id', 'port', 'subcommand',
+              'safe_mode', 'restore_rootfs', 'serial', 'outcome', 'failed_stage', 'error', 'retries', 'bytes_uploaded')
+
+
+class RunHistory:
+    """SQLite store of past runs, kept as history.db in the data dir."""
+
+    def __init__(self, data_dir: Path) -> None:
+        self.path = Path(data_dir) / 'history.db'
+        self.db = connect(str(self.path))
+        self.db.row_factory = Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.migrate()
+
+    def migrate(self) -> None:
+        """Create the tables, or upgrade them if the database is from an older version."""
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0 and self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'runs'").fetchone():
+            version = 1
+
+        with self.db:
+            if version:
+                for target in range(version + 1, SCHEMA_VERSION + 1):
+                    for statement in MIGRATIONS.get(target, ()):
+                        self.db.execute(statement)
+
+            self.db.executescript(SCHEMA)
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self) -> None:
+        self.db.close()
+
+    def start(self, args: Namespace) -> 'Run':
+        """Record the start of a run.
+
+        :param Namespace args: Args object
+        :return: Run to record stages in
+        :rtype: Run
+        """
+
+        with self.db:
+            cur = self.db.execute(
+                'INSERT INTO runs (started_at, subcommand, safe_mode, restore_rootfs, serial) VALUES (?, ?, ?, ?, ?)',
+                (time(), args.subcommand, int(bool(args.safe_mode)), int(bool(args.restore_rootfs)), int(bool(args.serial))))
+
+        return Run(self, cur.lastrowid)
+
+    def runs(self, since: float = None, kind: str = None) -> list:
+        """Get finished runs, oldest first.
+
+        :param float since: Only include runs started after this timestamp (defaults to None)
+        :param str kind: boot, dfuhelper or None for every run (defaults to None)
+        :return: Rows from the runs table
+        :rtype: list
+        """
+
+        return self.db.execute(f"SELECT * FROM runs WHERE outcome != 'running' AND started_at >= ? AND {KINDS[kind]} "
+                               f"ORDER BY started_at", (since or 0,)).fetchall()
+
+    def stage_durations(self, since: float = None, kind: str = 'boot') -> dict:
+        """Get successful stage durations, sorted, per stage name.
+
+        :param float since: Only include runs started after this timestamp (defaults to None)
+        :param str kind: boot, dfuhelper or None for every run (defaults to boot)
+        :return: Durations per stage
+        :rtype: dict
+        """
+
+        durations = {}
+        rows = self.db.execute(f'SELECT stages.name, stages.duration FROM stages JOIN runs ON runs.id = stages.run_id '
+                               f'WHERE stages.ok = 1 AND runs.started_at >= ? AND {KINDS[kind]} '
+                               f'ORDER BY stages.name, stages.duration', (since or 0,))
+        for name, duration in rows:
+            durations.setdefault(name, []).append(duration)
+
+        return durations
+
+    def stages(self, run_id: int) -> dict:
+        """Get the total duration of each stage in a run.
+
+        :param int run_id: Run ID
+        :return: Seconds per stage
+        :rtype: dict
+        """
+
+        rows = self.db.execute('SELECT name, SUM(duration) FROM stages WHERE run_id = ? GROUP BY name ORDER BY MIN(started_at)',
+                               (run_id,))
+        return {name: duration for name, duration in rows}
+
+    def hot_spots(self, column: str, since: float = None, limit: int = 5, kind: str = 'boot') -> list:
+        """Count failed runs grouped by a column.
+
+        :param str column: One of failed_stage, product_type, port or error
+        :param float since: Only include runs started after this timestamp (defaults to None)
+        :param int limit: Max amount of groups (defaults to 5)
+        :param str kind: boot, dfuhelper or None for every run (defaults to boot)
+        :return: (value, failures, runs) tuples, most failures first
+        :rtype: list
+        """
+
+        if column not in ('failed_stage', 'product_type', 'port', 'error'):
+            raise ValueError(f'Cannot group by {column}')
+
+        return self.db.execute(f"SELECT {column}, SUM(outcome = 'failed') AS failures, COUNT(*) FROM runs "
+                               f"WHERE outcome != 'running' AND started_at >= ? AND {KINDS[kind]} GROUP BY {column} "
+                               f"HAVING failures > 0 ORDER BY failures DESC LIMIT ?", (since or 0, limit)).fetchall()
+
+
+    def stage_errors(self, since: float = None, limit: int = 5, kind: str = 'boot') -> list:
+        """Count failed stage attempts, including ones that were retried.
+
+        :param float since: Only include runs started after this timestamp (defaults to None)
+        :param int limit: Max amount of groups (defaults to 5)
+        :param str kind: boot, dfuhelper or None for every run (defaults to boot)
+        :return: (stage, error, count) tuples, most common first
+        :rtype: list
+        """
+
+        return self.db.execute(f'SELECT stages.name, stages.error, COUNT(*) AS count FROM stages JOIN runs ON runs.id = stages.run_id '
+                               f'WHERE stages.ok = 0 AND runs.started_at >= ? AND {KINDS[kind]} GROUP BY stages.name, stages.error '
+                               f'ORDER BY count DESC LIMIT ?', (since or 0, limit)).fetchall()
+
+
+class Run:
+    """A single run being recorded."""
+
+    def __init__(self, history: RunHistory, run_id: int) -> None:
+        self.history = history
+        self.id = run_id
+        self.current = None
+        self.failed_stage = None
+
+    def update(self, **fields) -> None:
+        """Set columns of the run, e.g. ecid or port.
+
+        Values that are None are ignored.
+        """
+
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return
+
+        with self.history.db:
+            self.history.db.execute(f'UPDATE runs SET {", ".join(f"{k} = ?" for k in fields)} WHERE id = ?',
+                                    (*fields.values(), self.id))
+
+    def add(self, column: str, amount: int) -> None:
+        """Add to a counter column of the run.
+
+        :param str column: retries or bytes_uploaded
+        :param int amount: Amount to add
+        """
+
+        if column not in ('retries', 'bytes_uploaded'):
+            raise ValueError(f'{column} is not a counter')
+
+        with self.history.db:
+            self.history.db.execute(f'UPDATE runs SET {column} = {column} + ? WHERE id = ?', (amount, self.id))
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the run.
+
+        :param str name: Name of the stage
+        """
+
+        started_at = time()
+        start = monotonic()
+        previous, self.current = self.current, name
+        ok = False
+        error = None
+        try:
+            yield
+            ok = True
+        except BaseException as err:
+            error = str(err) or type(err).__name__
+            raise
+        finally:
+            if not ok:
+                self.failed_stage = name
+            self.current = previous
+            with self.history.db:
+                self.history.db.execute('INSERT INTO stages (run_id, name, started_at, duration, ok, error) VALUES (?, ?, ?, ?, ?, ?)',
+                                        (self.id, name, started_at, monotonic() - start, int(ok), error))
+
+    def finish(self, outcome: str, error: Union[str, None] = None) -> None:
+        """Record the end of the run.
+
+        :param str outcome: success, failed or aborted
+        :param str error: Error message if it failed (defaults to None)
+        """
+
+        with self.history.db:
+            self.history.db.execute('UPDATE runs SET finished_at = ?, outcome = ?, failed_stage = ?, error = ? WHERE id = ?',
+                                    (time(), outcome, self.failed_stage if outcome != 'success' else None, error, self.id))
+
+
+def percentile(values: list, pct: float) -> float:
+    """Get a percentile of sorted values, using the nearest rank.
+
+    :param list values: Sorted values
+    :param float pct: Percentile between 0 and 100
+    :return: Value at that percentile
+    :rtype: float
+    """
+
+    index = max(0, min(len(values), ceil(pct / 100 * len(values))) - 1)
+    return values[index]
+
+
+def print_stages(history: RunHistory, since: float = None, kind: str = 'boot') -> None:
+    """Print stage duration percentiles.
+
+    :param RunHistory history: History to report on
+    :param float since: Only include runs started after this timestamp (defaults to None)
+    :param str kind: boot, dfuhelper or None for every run (defaults to boot)
+    """
+
+    print(f'  {"stage":<16}{"count":>7}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}')
+    for name, durations in history.stage_durations(since, kind).items():
+        print(f'  {name:<16}{len(durations):>7}{percentile(durations, 50):>9.2f}{percentile(durations, 90):>9.2f}'
+              f'{percentile(durations, 99):>9.2f}{durations[-1]:>9.2f}')
+
+
+def report(history: RunHistory, since: float = None) -> None:
+    """Print throughput, stage percentiles and failure hot spots.
+
+    Only boots count towards throughput and the boot tables, dfuhelper runs
+    get a section of their own.
+
+    :param RunHistory history: History to report on
+    :param float since: Only include runs started after this timestamp (defaults to None)
+    """
+
+    runs = history.runs(since, 'boot')
+    dfu_runs = history.runs(since, 'dfuhelper')
+    if not runs and not dfu_runs:
+        print('No runs recorded yet.')
+        return
+
+    if runs:
+        succeeded = sum(1 for r in runs if r['outcome'] == 'success')
+        failed = sum(1 for r in runs if r['outcome'] == 'failed')
+        span = (max(r['finished_at'] or r['started_at'] for r in runs) - runs[0]['started_at']) / 3600
+
+        print(colors['bold'] + 'Boots' + colors['reset'])
+        print(f'  {len(runs)} total, {succeeded} succeeded, {failed} failed, {len(runs) - succeeded - failed} aborted '
+              f'({succeeded / len(runs) * 100:.1f}% success)')
+        if span > 0:
+            print(f'  {succeeded / span:.1f} devices/hour over {span:.2f} hours')
+        print(f'  {sum(r["retries"] for r in runs)} retries, {sum(r["bytes_uploaded"] for r in runs) / 1e6:.1f} MB uploaded')
+
+        print('\n' + colors['bold'] + 'Boot stages (seconds)' + colors['reset'])
+        print_stages(history, since)
+
+        errors = history.stage_errors(since)
+        if errors:
+            print('\n' + colors['bold'] + 'Stage errors, including retried ones' + colors['reset'])
+            for name, error, count in errors:
+                print(f'  {count:>4} {name}: {error}')
+
+        for column, title in (('failed_stage', 'stage'), ('product_type', 'device'), ('port', 'port'), ('error', 'error')):
+            spots = history.hot_spots(column, since)
+            if not spots:
+                continue
+
+            print('\n' + colors['bold'] + f'Failures by {title}' + colors['reset'])
+            for value, failures, total in spots:
+                print(f'  {failures:>4}/{total:<4} {value if value is not None else "unknown"}')
+
+    if dfu_runs:
+        succeeded = sum(1 for r in dfu_runs if r['outcome'] == 'success')
+        print(('\n' if runs else '') + colors['bold'] + 'DFU helper runs' + colors['reset'])
+        print(f'  {len(dfu_runs)} total, {succeeded} reached DFU ({succeeded / len(dfu_runs) * 100:.1f}%)')
+        print_stages(history, since, 'dfuhelper')
+
+
+def export(history: RunHistory, fmt: str, output: TextIO = stdout, since: float = None) -> None:
+    """Export runs with their stage durations.
+
+    :param RunHistory history: History to export
+    :param str fmt: csv or json
+    :param TextIO output: File to write to (defaults to stdout)
+    :param float since: Only include runs started after this timestamp (defaults to None)
+    """
+
+    rows = []
+    for run in history.runs(since):
+        row = {field: run[field] for field in RUN_FIELDS}
+        row['stages'] = history.stages(run['id'])
+        rows.append(row)
+
+    if fmt == 'json':
+        dump(rows, output, indent=4)
+        output.write('\n')
+    elif fmt == 'csv':
+        stage_names = []
+        for row in rows:
+            stage_names += [name for name in row['stages'] if name not in stage_names]
+
+        writer = DictWriter(output, fieldnames=list(RUN_FIELDS) + [f'stage_{name}' for name in stage_names])
+        writer.writeheader()
+        for row in rows:
+            stages = row.pop('stages')
+            writer.writerow({**row, **{f'stage_{name}': duration for name, duration in stages.items()}})
+    else:
+        raise ValueError(f'Unknown export format {fmt}')
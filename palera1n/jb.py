@@ -5,9 +5,9 @@ from pathlib import Path
 from platform import machine
 from requests import get
 from requests.exceptions import RequestException, ConnectionError
+from shlex import join
 from shutil import move
-from struct import pack
-from subprocess import getstatusoutput
+from subprocess import PIPE, STDOUT, TimeoutExpired, run
 from typing import Union
 from urllib3.exceptions import NewConnectionError
 from usb.core import find
@@ -15,8 +15,11 @@ from usb.util import dispose_resources
 from time import sleep
 
 # local imports
+from . import artifacts
 from . import utils
 from . import logger
+from . import upload
+from .exceptions import Checkra1nError, DeviceNotFoundError, DeviceTimeoutError
 from .logger import colors
 
 
@@ -103,7 +106,10 @@ class checkra1n:
         logger.debug(f'Moved checkra1n to {self.data_dir / "binaries/checkra1n"}', self.args.debug)
 
     def download(self) -> None:
-        """Download the checkra1n binary."""
+        """Download the checkra1n binary.
+        
+        :raises Checkra1nError: If checkra1n can't be downloaded and isn't already present
+        """
         
         # Check for checkra1n's presence in data directory
         exists = self.exists_in_data_dir()
@@ -135,8 +141,7 @@ class checkra1n:
                     logger.log('Could not verify remote hash, falling back to checkra1n found in path',
                                color=colors['yellow'])
                 else:
-                    logger.error('Download url is not reachable, and no checkra1n found in path, exiting.')
-                    exit(1)
+                    raise Checkra1nError('Download url is not reachable, and no checkra1n found in path, exiting.')
             # If hashes do not match but the content is not empty, save it to a file
             else:
                 logger.debug(f'checkra1n hash failed to verify, saving newer version', self.args.debug)
@@ -146,104 +151,157 @@ class Jailbreak:
     def __init__(self, data_dir: Path, args: Namespace) -> None:
         self.data_dir = data_dir
         self.args = args
+        self.tuner = upload.UploadTuner(data_dir, args)
+        self.port = None
+        self.bytes_uploaded = 0
 
-    def run_checkra1n(self, ramdisk: Path = None, overlay: Path = None, kpf: Path = None, pongo_bin: Path = None, 
-                      boot_args: str = None, force_revert: bool = False, safe_mode: bool = False, 
-                      exit_early: bool = False, pongo: bool = False, pongo_full: bool = False) -> None:
-        """Run checkra1n."""
+    def checkra1n_command(self, ramdisk: Path = None, overlay: Path = None, kpf: Path = None, pongo_bin: Path = None, 
+                          boot_args: str = None, force_revert: bool = False, safe_mode: bool = False, 
+                          exit_early: bool = False, pongo: bool = False, pongo_full: bool = False) -> list:
+        """Build the checkra1n command line.
+        
+        :return: Arguments, starting with the checkra1n binary
+        :rtype: list
+        """
 
-        cmd = f'{self.data_dir / "binaries/checkra1n"}'
+        cmd = [str(self.data_dir / 'binaries/checkra1n')]
         if ramdisk != None:
-            cmd = f'{cmd} -r {ramdisk}'
+            cmd += ['-r', str(ramdisk)]
             
         if overlay != None:
-            cmd = f'{cmd} -o {overlay}'
+            cmd += ['-o', str(overlay)]
             
         if kpf != None:
-            cmd = f'{cmd} -K {kpf}'
+            cmd += ['-K', str(kpf)]
             
         if pongo_bin != None:
-            cmd = f'{cmd} -k {pongo_bin}'
+            cmd += ['-k', str(pongo_bin)]
             
         if boot_args != None:
-            cmd = f'{cmd} -e \'{boot_args}\''
+            cmd += ['-e', boot_args]
             
         if force_revert == True:
-            cmd = f'{cmd} --force-revert'
+            cmd.append('--force-revert')
             
         if safe_mode == True:
-            cmd = f'{cmd} -s'
+            cmd.append('-s')
             
         if exit_early == True:
-            cmd = f'{cmd} -E'
+            cmd.append('-E')
             
         if pongo == True:
-            cmd = f'{cmd} -p'
+            cmd.append('-p')
             
         if pongo_full == True:
-            cmd = f'{cmd} -P'
+            cmd.append('-P')
+
+        return cmd
+
+    def run_checkra1n(self, timeout: float = None, **kwargs) -> None:
+        """Run checkra1n.
+        
+        Takes the same keyword arguments as checkra1n_command.
+        
+        :param float timeout: Seconds before checkra1n is killed, None waits forever (defaults to None)
+        :raises Checkra1nError: If checkra1n exited with an error
+        :raises DeviceTimeoutError: If checkra1n was killed after the timeout
+        """
+
+        cmd = self.checkra1n_command(**kwargs)
 
         print('Running checkra1n...')
-        logger.debug(f'Running command: {cmd}', self.args.debug)
+        logger.debug(f'Running command: {join(cmd)}', self.args.debug)
 
-        code, output = getstatusoutput(cmd)
+        try:
+            proc = run(cmd, stdout=PIPE, stderr=STDOUT, text=True, timeout=timeout)
+        except TimeoutExpired:
+            raise DeviceTimeoutError(f'checkra1n did not finish within {timeout:g} seconds')
 
-        if code != 0:
-            logger.error(f'Failed to run checkra1n: {output}')
-            exit(1)
+        if proc.returncode != 0:
+            raise Checkra1nError(f'Failed to run checkra1n: {proc.stdout.rstrip()}')
     
     def pongo_send_cmd(self, cmd: str) -> None:
         """Run a command on device using Pongo.
         
         :param str cmd: Command to run
+        :raises DeviceNotFoundError: If no device is in Pongo
         """
         
-        dev = find(idVendor=0x05ac, idProduct=0x4141)
-        if dev is None:
-            logger.error('Device not found')
-            exit(1)
-        
-        dev.set_configuration()
-        logger.debug(f'Running Pongo command: {cmd}', self.args.debug)
-        sent = False
-        while sent == False:
-            dev.ctrl_transfer(0x21, 3, 0, 0, f'{cmd}\n')
-            sent = True
-            
-        dispose_resources(dev)
+        dev = pongo_find()
+        try:
+            dev.set_configuration()
+            self.pongo_write_cmd(dev, cmd)
+        finally:
+            dispose_resources(dev)
         sleep(1)
     
-    def pongo_send_file(self, file: Path, modload: bool = False) -> None:
+    def pongo_send_file(self, file: Path, modload: bool = False, timeout: float = None) -> None:
         """Send a file to device using Pongo.
         
         :param Path file: File to send
         :param bool modload: Defaults to False
+        :param float timeout: Seconds the upload may take (defaults to 100)
+        :raises DeviceNotFoundError: If no device is in Pongo
+        :raises USBTimeoutError: If the upload took longer than the timeout
         """
         
-        dev = find(idVendor=0x05ac, idProduct=0x4141)
-        if dev is None:
-            logger.error('Device not found')
-            exit(1)
+        dev = pongo_find()
+        try:
+            dev.set_configuration()
+            self.pongo_write_file(dev, file, modload, timeout)
+        finally:
+            dispose_resources(dev)
+        sleep(1)
+
+    def pongo_write_cmd(self, dev, cmd: str) -> None:
+        """Run a command on an already configured Pongo device.
+        
+        :param dev: USB device
+        :param str cmd: Command to run
+        """
+        
+        logger.debug(f'Running Pongo command: {cmd}', self.args.debug)
+        dev.ctrl_transfer(0x21, 3, 0, 0, f'{cmd}\n')
+
+    def pongo_write_file(self, dev, file: Path, modload: bool = False, timeout: float = None) -> None:
+        """Upload a file to an already configured Pongo device.
+        
+        :param dev: USB device
+        :param Path file: File to send
+        :param bool modload: Defaults to False
+        :param float timeout: Seconds the upload may take (defaults to 100)
+        """
+        
+        with artifacts.open_artifact(file) as f:
+            size = f.size
             
-        with open(file, 'rb') as f:
-            data = f.read()
+            packet_size = upload.max_packet_size(dev)
+            port = utils.port_key(dev)
+            chunk_size = self.tuner.choose(port, packet_size, size)
+            logger.debug(f'Sending {file} ({size} bytes) in {chunk_size} byte chunks on port {port}', self.args.debug)
             
-            sent = False
-            dev.set_configuration()
-            while sent == False:
-                dev.ctrl_transfer(0x21, 2, 0, 0, 0)
-                dev.ctrl_transfer(0x21, 1, 0, 0, pack('I', len(data)))
-                dev.write(2, data, 100000)
-                
-                if utils.is_linux():
-                    if len(data) % 512 == 0:
-                        dev.write(2, '')
-                
-                sent = True
+            seconds = upload.send(dev, f, size, chunk_size, 100000 if timeout is None else max(int(timeout * 1000), 1))
+            self.tuner.record(port, chunk_size, size, seconds)
+            self.port = port
+            self.bytes_uploaded += size
+            self.tuner.save()
+            if seconds > 0:
+                logger.debug(f'Sent {file} at {size / seconds / 1e6:.2f} MB/s', self.args.debug)
                 
-            if modload:
-                logger.debug('Running Pongo command: modload', self.args.debug)
-                dev.ctrl_transfer(0x21, 3, 0, 0, 'modload\n')
-        
-        dispose_resources(dev)
-        sleep(1)
\ No newline at end of file
+        if modload:
+            self.pongo_write_cmd(dev, 'modload')
+
+
+def pongo_find(selector: str = None):
+    """Find the device in Pongo.
+    
+    :param str selector: Port key or ECID of the device, None takes the first one (defaults to None)
+    :return: USB device
+    :raises DeviceNotFoundError: If no device is in Pongo
+    """
+    
+    for dev in find(find_all=True, idVendor=0x05ac, idProduct=0x4141):
+        if utils.matches_device(dev, selector):
+            return dev
+    
+    raise DeviceNotFoundError('Device not found' if selector is None else f'Device {selector} not found in Pongo')
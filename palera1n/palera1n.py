@@ -2,17 +2,26 @@
 from argparse import Namespace
 from pathlib import Path
 from subprocess import getoutput
-from time import sleep
+from time import sleep, time
 from pymobiledevice3.irecv import IRecv
 from sys import exit
 from shutil import rmtree
+from typing import Callable
 from requests import post
 
 # local imports
+from . import artifacts
+from . import dfu
+from . import history
+from . import scan
 from . import utils
 from . import logger
-from .jb import checkra1n, Jailbreak
+from . import upload
+from .exceptions import Palera1nError, StageTimeoutError
+from .history import RunHistory
+from .jb import checkra1n, Jailbreak, pongo_find
 from .logger import colors
+from .watchdog import Watchdog
 
 
 class palera1n:
@@ -28,6 +37,9 @@ class palera1n:
         self.os = getoutput('uname')
         self.irecv = None
         self.jb = None
+        self.selector = None
+        self.run = None
+        self.watchdog = Watchdog(dict(args.deadline or []), args.debug)
 
     def main(self) -> None:
         print(colors['bold'] + colors['lightblue'] + 'palera1n' + colors['reset'] + colors['bold'] + f' | version {utils.get_version()}' + colors['reset'])
@@ -54,87 +66,299 @@ class palera1n:
             rmtree(self.data_dir)
             exit(0)
         
+        if self.args.subcommand == 'scan':
+            results = scan.scan()
+            if self.args.json:
+                print(scan.to_json(results))
+            else:
+                scan.print_table(results)
+            exit(0)
+        
+        if self.args.subcommand == 'pack':
+            if not self.args.paths:
+                raise Palera1nError('Specify the files to compress, e.g. palera1n pack ramdisk.dmg binpack.dmg')
+            for path in self.args.paths:
+                dest = artifacts.pack(path)
+                print(f'Compressed {path} to {dest} ({Path(dest).stat().st_size * 100 // max(Path(path).stat().st_size, 1)}% of original size)')
+            exit(0)
+        
+        if self.args.subcommand == 'uploadbench':
+            if self.args.simulate:
+                # Keep simulated results out of upload.json
+                dev = upload.SimulatedDevice()
+                tuner = upload.UploadTuner(None, self.args)
+            else:
+                utils.wait('pongo')
+                dev = pongo_find()
+                tuner = upload.UploadTuner(self.data_dir, self.args)
+            upload.benchmark(dev, tuner)
+            exit(0)
+        
+        if self.args.subcommand == 'history':
+            run_history = RunHistory(self.data_dir)
+            since = time() - self.args.since * 3600 if self.args.since else None
+            if self.args.export:
+                if self.args.output:
+                    with open(self.args.output, 'w', newline='') as f:
+                        history.export(run_history, self.args.export, f, since)
+                else:
+                    history.export(run_history, self.args.export, since=since)
+            else:
+                history.report(run_history, since)
+            run_history.close()
+            exit(0)
+        
+        run_history = RunHistory(self.data_dir)
+        self.run = run_history.start(self.args)
+        try:
+            self.boot()
+        except KeyboardInterrupt:
+            self.finish_run('aborted')
+            raise
+        except SystemExit as err:
+            self.finish_run('success' if not err.code else 'failed')
+            raise
+        except Exception as err:
+            self.finish_run('failed', str(err))
+            raise
+        else:
+            self.finish_run('success')
+        finally:
+            run_history.close()
+        
+        if self.args.subcommand == 'dfuhelper':
+            return
+        
+        logger.log('Done!')
+        logger.log('The device should now boot to jailbroken iOS', nln=False)
+        logger.log('If you have any issues or questions, please ask in our Discord server: https://dsc.gg/palera1n', nln=False)
+        logger.log('Also, this is free and open source software! Feel free to donate to our Patreon if you enjoy :)', nln=False)
+        print(f'    {colors["yellow"]}https://patreon.com/palera1n')
+        
+        if not self.args.disable_analytics:
+            try:
+                req = post('https://ohio.itsnebula.net/hit', json={'app_name': 'palera1n_py-rewrite'})
+            except:
+                pass
+
+    def boot(self) -> None:
+        """Get the device into DFU mode and boot it, recording each stage."""
+        
+        self.jb = Jailbreak(self.data_dir, self.args)
+        
         # Dependency check
         if self.args.subcommand != 'dfuhelper' and not self.args.disable_hash_checking:
-            logger.log('Checking for dependencies...')
-            print('Checking for checkra1n')
-            checkra1n(self.data_dir, self.args).download()
+            with self.run.stage('dependencies'):
+                logger.log('Checking for dependencies...')
+                print('Checking for checkra1n')
+                checkra1n(self.data_dir, self.args).download()
 
+        self.stage('detect', self.detect)
+        
+        if utils.get_device_mode() != 'dfu':
+            self.stage('recovery', self.enter_recovery, self.reenumerate)
+            self.stage('dfu', self.enter_dfu, self.reenter_recovery)
+        else:
+            self.stage('dfu', self.wait_in_dfu, self.reenumerate)
+        
+        if self.args.subcommand == 'dfuhelper':
+            return
+        
+        # Lets actually boot the device
+        logger.log('Booting device')
+        self.stage('checkra1n', self.checkra1n, self.wait_for_dfu)
+        self.stage('pongo', self.wait_for_pongo, self.rerun_checkra1n)
+        self.stage('upload', self.upload, self.rerun_checkra1n)
+        self.stage('boot', self.send_boot, self.reload)
+    
+    def stage(self, name: str, func: Callable[[], None], recovery: Callable[[], None] = None) -> None:
+        """Run a stage under its deadline, recovering and retrying if it times out.
+        
+        :param str name: Name of the stage
+        :param Callable func: Function that runs the stage
+        :param Callable recovery: Function that gets the device ready to retry the stage (defaults to None)
+        :raises StageTimeoutError: If the stage timed out and could not be recovered
+        """
+        
+        attempt = 0
+        while True:
+            try:
+                with self.run.stage(name), self.watchdog.stage(name):
+                    func()
+                return
+            except StageTimeoutError as err:
+                if recovery is None or attempt >= self.args.retries:
+                    raise
+                
+                attempt += 1
+                self.run.add('retries', 1)
+                logger.error(str(err))
+                logger.log(f'Trying to recover ({attempt}/{self.args.retries}): {recovery.__name__.replace("_", " ")}')
+                recovery()
+    
+    def detect(self) -> None:
         logger.log('Waiting for devices...')
             
-        while utils.get_device_mode() == 'none':
+        while utils.get_device_mode() == 'none' and not self.watchdog.expired:
             sleep(1)
+        self.watchdog.check()
         
         mode = utils.get_device_mode()
         print(f'Detected device in {"DFU" if mode == "dfu" else mode} mode')
-        self.jb = Jailbreak(self.data_dir, self.args)
         
-        if utils.get_device_mode() == 'pongo':
+        if mode == 'pongo':
             print('Rebooting device in Pongo')
             self.jb.pongo_send_cmd('bootux')
             
             logger.log('Waiting for devices...')
-            while utils.get_device_mode() == 'none':
+            while utils.get_device_mode() == 'none' and not self.watchdog.expired:
                 sleep(1)
+            self.watchdog.check()
+        
+        # Remember the port, so resets only ever hit this device
+        devices = utils.find_devices()
+        if len(devices) == 1:
+            self.selector = utils.port_key(devices[0][0])
         
         # Get device info, then debug log them
         if utils.get_device_mode() == 'normal':
             if utils.device_info('CPUArchitecture') == 'arm64e':
-                logger.error('palera1n does not support arm64e devices, and never will')
-                exit(1)
+                raise Palera1nError('palera1n does not support arm64e devices, and never will')
+    
+    def enter_recovery(self) -> None:
+        # Lockdown and IRecv calls can't be interrupted, so kick the device off the bus if they hang
+        self.watchdog.on_cancel(self.reset_device)
         
-        if utils.get_device_mode() != 'dfu':
-            if utils.get_device_mode() == 'recovery':
-                self.irecv = IRecv()
-                self.irecv._reinit(ecid=self.irecv.ecid)
-            else:
-                logger.log('Entering recovery mode...')
-                utils.enter_recovery()
-                utils.wait('recovery')
-                self.irecv = IRecv()
-                self.irecv._reinit(ecid=self.irecv.ecid)
-                self.irecv.set_autoboot(True)
-                print('Entered recovery mode.')
-            utils.guide_to_dfu(str(self.irecv.chip_id), str(self.irecv.product_type), self.irecv)
-        utils.wait('dfu')
+        # The device may still be re-enumerating after a recovery action
+        while utils.get_device_mode() == 'none' and not self.watchdog.expired:
+            sleep(1)
+        self.watchdog.check()
         
-        if self.args.subcommand == 'dfuhelper':
-            exit(0)
+        mode = utils.get_device_mode()
+        if mode == 'dfu':
+            print('Device is already in DFU mode.')
+            self.record_dfu_identity()
+            return
+        elif mode == 'recovery':
+            self.irecv = IRecv()
+            self.irecv._reinit(ecid=self.irecv.ecid)
+        elif mode != 'normal':
+            raise Palera1nError(f'Cannot enter recovery mode from {mode} mode')
+        else:
+            logger.log('Entering recovery mode...')
+            utils.enter_recovery()
+            utils.wait('recovery', timeout=self.watchdog.remaining())
+            self.irecv = IRecv()
+            self.irecv._reinit(ecid=self.irecv.ecid)
+            self.irecv.set_autoboot(True)
+            print('Entered recovery mode.')
+        self.run.update(ecid=hex(self.irecv.ecid), product_type=str(self.irecv.product_type),
+                        chip_id=str(self.irecv.chip_id))
+    
+    def enter_dfu(self) -> None:
+        # A previous attempt may have gotten there after its deadline
+        if utils.get_device_mode() == 'dfu':
+            return
         
-        # Lets actually boot the device
-        logger.log('Booting device')
-        boot_args = f'{"serial=3" if self.args.serial else "-v"} rootdev=md0'
-        ramdisk = utils.get_resource('ramdisk.dmg', self.in_package)
-        overlay = utils.get_resource('binpack.dmg', self.in_package)
-        kpf = utils.get_resource('kpf', self.in_package)
-        pongo = utils.get_resource('Pongo.bin', self.in_package)
+        if not self.args.non_interactive:
+            logger.ask('Press enter when you\'re ready to enter DFU mode.')
+            # The deadline is for the button sequence, not for waiting on the operator
+            self.watchdog.restart()
         
+        dfu.guide_to_dfu(str(self.irecv.chip_id), str(self.irecv.product_type), self.irecv,
+                         timings=dfu.load_timings(self.data_dir), interactive=False, hook=self.args.dfu_hook,
+                         selector=self.selector)
+        utils.wait('dfu', timeout=self.watchdog.remaining())
+    
+    def wait_in_dfu(self) -> None:
+        utils.wait('dfu', timeout=self.watchdog.remaining())
+        self.record_dfu_identity()
+    
+    def record_dfu_identity(self) -> None:
+        # There's no lockdown or recovery step to read the identity from, so use the DFU serial number
+        for dev, mode in utils.find_devices():
+            if mode == 'dfu':
+                fields = utils.parse_iboot_serial(utils.usb_serial(dev))
+                self.run.update(ecid=hex(int(fields['ECID'], 16)) if 'ECID' in fields else None,
+                                chip_id=str(int(fields['CPID'], 16)) if 'CPID' in fields else None,
+                                port=utils.port_key(dev))
+                break
+    
+    def checkra1n(self) -> None:
         sleep(3)
-        self.jb.run_checkra1n(pongo_bin=pongo, exit_early=True, pongo_full=True, 
-                              force_revert=True if self.args.restore_rootfs else False, safe_mode=True if self.args.safe_mode else False)
+        self.jb.run_checkra1n(timeout=self.watchdog.remaining(), pongo_bin=artifacts.materialize(self.resource('Pongo.bin'), self.data_dir / 'cache'), exit_early=True,
+                              pongo_full=True, force_revert=True if self.args.restore_rootfs else False,
+                              safe_mode=True if self.args.safe_mode else False)
+    
+    def wait_for_pongo(self) -> None:
         print('Waiting for Pongo to boot')
-        utils.wait('pongo', no_log=True)
+        utils.wait('pongo', no_log=True, timeout=self.watchdog.remaining())
         sleep(2)
-        self.jb.pongo_send_file(kpf, modload=True)
-        self.jb.pongo_send_file(ramdisk)
+    
+    def upload(self) -> None:
+        # Resetting the device aborts a bulk write that is stuck in libusb
+        self.watchdog.on_cancel(self.reset_device)
+        
+        self.jb.pongo_send_file(self.resource('kpf'), modload=True, timeout=self.watchdog.remaining())
+        self.jb.pongo_send_file(self.resource('ramdisk.dmg'), timeout=self.watchdog.remaining())
         self.jb.pongo_send_cmd('ramdisk')
-        self.jb.pongo_send_file(overlay)
+        self.jb.pongo_send_file(self.resource('binpack.dmg'), timeout=self.watchdog.remaining())
         self.jb.pongo_send_cmd('overlay')
+    
+    def send_boot(self) -> None:
+        self.watchdog.on_cancel(self.reset_device)
+        
+        boot_args = f'{"serial=3" if self.args.serial else "-v"} rootdev=md0'
         self.jb.pongo_send_cmd('fuse lock')
         self.jb.pongo_send_cmd(f'checkra1n_flags {utils.checkra1n_flags(self.args)}')
         self.jb.pongo_send_cmd(f'xargs {boot_args}')
         self.jb.pongo_send_cmd('xfb')
         self.jb.pongo_send_cmd('sep auto')
         self.jb.pongo_send_cmd('bootx')
-            
-        logger.log('Done!')
-        logger.log('The device should now boot to jailbroken iOS', nln=False)
-        logger.log('If you have any issues or questions, please ask in our Discord server: https://dsc.gg/palera1n', nln=False)
-        logger.log('Also, this is free and open source software! Feel free to donate to our Patreon if you enjoy :)', nln=False)
-        print(f'    {colors["yellow"]}https://patreon.com/palera1n')
+    
+    def resource(self, name: str) -> Path:
+        return utils.get_resource(name, self.in_package)
+    
+    # Recovery actions, run before a stage that timed out is retried
+    
+    def reset_device(self) -> None:
+        utils.reenumerate(self.selector)
+    
+    def reenumerate(self) -> None:
+        self.reset_device()
+        sleep(2)
+    
+    def reenter_recovery(self) -> None:
+        # Nothing to do if the device made it into DFU after all
+        if utils.get_device_mode() == 'dfu':
+            return
         
-        if not self.args.disable_analytics:
-            try:
-                req = post('https://ohio.itsnebula.net/hit', json={'app_name': 'palera1n_py-rewrite'})
-            except:
-                pass
+        # The reset invalidates the old IRecv handle, so always reconnect, even if it came back in recovery
+        self.reenumerate()
+        self.stage('recovery', self.enter_recovery)
+    
+    def wait_for_dfu(self) -> None:
+        self.reenumerate()
+        if utils.get_device_mode() != 'dfu':
+            logger.log('Put the device back into DFU mode')
+            self.stage('dfu', lambda: utils.wait('dfu', timeout=self.watchdog.remaining()))
+    
+    def rerun_checkra1n(self) -> None:
+        self.wait_for_dfu()
+        self.stage('checkra1n', self.checkra1n)
+        self.stage('pongo', self.wait_for_pongo)
+    
+    def reload(self) -> None:
+        self.rerun_checkra1n()
+        self.stage('upload', self.upload)
+    
+    def finish_run(self, outcome: str, error: str = None) -> None:
+        """Record how the run ended in the run history.
+        
+        :param str outcome: success, failed or aborted
+        :param str error: Error message if it failed (defaults to None)
+        """
+        
+        if self.jb is not None:
+            self.run.update(port=self.jb.port, bytes_uploaded=self.jb.bytes_uploaded)
+        self.run.finish(outcome, error)
@@ -0,0 +1,248 @@
+# module imports
+import subprocess
+import threading
+import tracemalloc
+from cProfile import Profile
+from pathlib import Path
+from pstats import Stats
+from sys import version_info
+from threading import Event, Lock, Thread
+from time import perf_counter, strftime
+from typing import Any, Callable
+
+# local imports
+from . import logger
+
+
+class SubprocessTracker:
+    """Counts and times every process started through subprocess.Popen."""
+
+    def __init__(self) -> None:
+        self.processes = []
+        self._original = None
+
+    def install(self) -> None:
+        """Replace subprocess.Popen so getoutput, run, etc. are tracked."""
+
+        tracker = self
+        self._original = original = subprocess.Popen
+
+        class TrackedPopen(original):
+            def __init__(self, args, *a, **kw):
+                self._palera1n_start = perf_counter()
+                self._palera1n_record = [args if isinstance(args, str) else ' '.join(str(arg) for arg in args), None]
+                super().__init__(args, *a, **kw)
+                tracker.processes.append(self._palera1n_record)
+
+            def wait(self, timeout=None):
+                code = super().wait(timeout)
+                if self._palera1n_record[1] is None:
+                    self._palera1n_record[1] = perf_counter() - self._palera1n_start
+                return code
+
+        subprocess.Popen = TrackedPopen
+
+    def uninstall(self) -> None:
+        if self._original is not None:
+            subprocess.Popen = self._original
+            self._original = None
+
+    def report(self, f) -> None:
+        """Write process count and time, grouped by command.
+
+        :param f: File to write to
+        """
+
+        finished = [(cmd, seconds) for cmd, seconds in self.processes if seconds is not None]
+        f.write(f'{len(self.processes)} subprocesses, {sum(s for _, s in finished):.3f} s total\n\n')
+
+        groups = {}
+        for cmd, seconds in finished:
+            count, total = groups.get(cmd, (0, 0.0))
+            groups[cmd] = (count + 1, total + seconds)
+
+        f.write(f'{"count":>6} {"total s":>9} {"avg ms":>9}  command\n')
+        for cmd, (count, total) in sorted(groups.items(), key=lambda g: g[1][1], reverse=True):
+            f.write(f'{count:>6} {total:>9.3f} {total / count * 1000:>9.1f}  {" ".join(cmd.split())}\n')
+
+
+class ThreadProfiler:
+    """Gives every thread started while installed its own Profile, so the
+    DFU watcher, artifact prefetch and executor threads show up in the report.
+
+    From Python 3.12 on, cProfile is built on sys.monitoring and the main
+    Profile already sees every thread, so nothing is installed.
+    """
+
+    def __init__(self) -> None:
+        self.profiles = []
+        self.enabled = version_info < (3, 12)
+        self._lock = Lock()
+
+    def install(self) -> None:
+        if self.enabled:
+            threading.setprofile(self._start)
+
+    def uninstall(self) -> None:
+        if self.enabled:
+            threading.setprofile(None)
+
+    def _start(self, frame, event, arg) -> None:
+        # Runs once, on the first event in the new thread, and swaps itself for a profiler
+        profiler = Profile()
+        with self._lock:
+            self.profiles.append((threading.current_thread().name, profiler))
+        profiler.enable()
+
+    def snapshots(self) -> list:
+        """Get the stats collected so far, including from threads that are still running.
+
+        :return: (thread name, snapshot) tuples that can be passed to Stats.add
+        :rtype: list
+        """
+
+        with self._lock:
+            profiles = list(self.profiles)
+
+        return [(name, _Snapshot(profiler)) for name, profiler in profiles]
+
+
+class _Snapshot:
+    """Stats of a profiler that may still be enabled in another thread.
+
+    Stats would disable the profiler, which only works from its own thread.
+    """
+
+    def __init__(self, profiler: Profile) -> None:
+        profiler.snapshot_stats()
+        self.stats = profiler.stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+class PeakSampler:
+    """Takes a tracemalloc snapshot whenever traced memory reaches a new high,
+    so allocations can be attributed to lines at the peak instead of at exit.
+
+    Memory is checked every few milliseconds, and tracemalloc's own peak is
+    reset each time, so a peak that came and went between two checks is
+    still noticed even though no snapshot of it could be taken.
+    """
+
+    def __init__(self, interval: float = 0.005, threshold: int = 64 * 1024) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.peak = 0
+        self.snapshot = None
+        self.max_traced = 0
+        self._stop = Event()
+        self._thread = Thread(target=self._sample, daemon=True)
+
+    def start(self) -> None:
+        tracemalloc.reset_peak()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._check()
+
+    def _check(self) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        if self.snapshot is None or current > self.peak + self.threshold:
+            self.peak = current
+            self.snapshot = tracemalloc.take_snapshot()
+        # The true peak, including ones freed again before they could be sampled
+        self.max_traced = max(self.max_traced, peak)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._check()
+
+
+def write_reports(out_dir: Path, profiler: Profile, threads: ThreadProfiler, sampler: PeakSampler, peak: int,
+                  tracker: SubprocessTracker, limit: int = 40) -> None:
+    """Write the CPU, memory and subprocess reports.
+
+    :param Path out_dir: Directory to write to
+    :param Profile profiler: Finished profiler of the main thread
+    :param ThreadProfiler threads: Profilers of the other threads
+    :param PeakSampler sampler: Finished peak sampler
+    :param int peak: Peak traced memory in bytes
+    :param SubprocessTracker tracker: Subprocess tracker
+    :param int limit: Amount of entries per table (defaults to 40)
+    """
+
+    snapshots = threads.snapshots()
+    with open(out_dir / 'cpu.txt', 'w') as f:
+        stats = Stats(profiler, stream=f)
+        for _, snapshot in snapshots:
+            stats.add(snapshot)
+        stats.dump_stats(str(out_dir / 'cpu.prof'))
+        stats.strip_dirs()
+
+        if threads.enabled:
+            names = ['main'] + [name for name, _ in snapshots]
+            f.write(f'Threads: {", ".join(names)} (the profiler\'s own memory sampler is excluded)\n')
+        else:
+            f.write('Threads: all, cProfile sees every thread on this Python version\n')
+        f.write('Sorted by cumulative time\n')
+        stats.sort_stats('cumulative').print_stats(limit)
+        f.write('Sorted by own time\n')
+        stats.sort_stats('tottime').print_stats(limit)
+
+    with open(out_dir / 'memory.txt', 'w') as f:
+        f.write(f'Peak traced memory: {peak / 1024 / 1024:.2f} MiB\n')
+        if sampler.snapshot is not None and peak > sampler.peak * 1.1 + sampler.threshold:
+            f.write(f'WARNING: the peak was too short-lived to snapshot, the table below is from the highest sampled '
+                    f'point ({sampler.peak / 1024 / 1024:.2f} MiB) and may not include what caused the peak\n')
+        if sampler.snapshot is not None:
+            snapshot = sampler.snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            ))
+            f.write(f'Allocations by line at {sampler.peak / 1024 / 1024:.2f} MiB:\n\n')
+            for stat in snapshot.statistics('lineno')[:limit]:
+                f.write(f'{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {stat.traceback}\n')
+
+    with open(out_dir / 'subprocess.txt', 'w') as f:
+        tracker.report(f)
+
+
+def run(func: Callable[[], Any], data_dir: Path) -> Any:
+    """Run a function under cProfile and tracemalloc, then write reports to the data dir.
+
+    Threads started by the function are profiled too, see ThreadProfiler.
+    Reports are written even if the function exits or raises.
+
+    :param Callable func: Function to profile
+    :param Path data_dir: Data directory, reports go in profiles/<timestamp>
+    :return: Whatever the function returns
+    """
+
+    out_dir = Path(data_dir) / 'profiles' / strftime('%Y%m%d-%H%M%S')
+    tracker = SubprocessTracker()
+    sampler = PeakSampler()
+    threads = ThreadProfiler()
+    profiler = Profile()
+
+    tracker.install()
+    tracemalloc.start()
+    sampler.start()
+    threads.install()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        threads.uninstall()
+        sampler.stop()
+        peak = sampler.max_traced
+        tracemalloc.stop()
+        tracker.uninstall()
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        write_reports(out_dir, profiler, threads, sampler, peak, tracker)
+        logger.log(f'Profile written to {out_dir}')
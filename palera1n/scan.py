@@ -0,0 +1,202 @@
+# module imports
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from pymobiledevice3.lockdown import LockdownClient
+from pymobiledevice3.usbmux import list_devices
+
+# local imports
+from . import utils
+from .logger import colors
+
+
+# Known chips, as CPID: (name, architecture)
+CHIPS = {
+    0x8960: ('A7', 'arm64'),
+    0x8965: ('A7', 'arm64'),
+    0x7000: ('A8', 'arm64'),
+    0x7001: ('A8X', 'arm64'),
+    0x8000: ('A9', 'arm64'),
+    0x8003: ('A9', 'arm64'),
+    0x8001: ('A9X', 'arm64'),
+    0x8010: ('A10', 'arm64'),
+    0x8011: ('A10X', 'arm64'),
+    0x8015: ('A11', 'arm64'),
+    0x8020: ('A12', 'arm64e'),
+    0x8027: ('A12X', 'arm64e'),
+    0x8030: ('A13', 'arm64e'),
+    0x8101: ('A14', 'arm64e'),
+    0x8103: ('M1', 'arm64e'),
+    0x8110: ('A15', 'arm64e'),
+    0x8112: ('M2', 'arm64e'),
+    0x8120: ('A16', 'arm64e'),
+}
+
+# checkm8 chips palera1n supports, A7 can't run a supported iOS version
+SUPPORTED_CPIDS = (0x7000, 0x7001, 0x8000, 0x8003, 0x8001, 0x8010, 0x8011, 0x8015)
+
+# Supported iOS versions, as (major, minor)
+MIN_VERSION = (15, 0)
+MAX_VERSION = (16, 3)
+
+
+def query_iboot(dev, info: dict) -> None:
+    """Fill in identity from the USB serial number of a device in recovery, DFU or Pongo.
+
+    :param dev: USB device
+    :param dict info: Device info to update
+    """
+
+    fields = utils.parse_iboot_serial(dev.serial_number)
+    if 'CPID' in fields:
+        cpid = int(fields['CPID'], 16)
+        info['cpid'] = hex(cpid)
+        info['chip'], info['arch'] = CHIPS.get(cpid, (None, None))
+    if 'ECID' in fields:
+        info['ecid'] = hex(int(fields['ECID'], 16))
+    if 'SRTG' in fields:
+        info['firmware'] = fields['SRTG']
+
+
+def query_lockdown(udid: str, info: dict) -> None:
+    """Fill in identity from lockdown for a device in normal mode.
+
+    :param str udid: UDID of the device
+    :param dict info: Device info to update
+    """
+
+    with LockdownClient(serial=udid, client_name='palera1n', usbmux_connection_type='USB') as lockdown:
+        values = lockdown.all_values
+
+    info['product_type'] = values.get('ProductType')
+    info['arch'] = values.get('CPUArchitecture')
+    info['version'] = values.get('ProductVersion')
+    if values.get('ChipID') is not None:
+        info['cpid'] = hex(values['ChipID'])
+        info['chip'] = CHIPS.get(values['ChipID'], (None, None))[0]
+    if values.get('UniqueChipID') is not None:
+        info['ecid'] = hex(values['UniqueChipID'])
+
+
+def classify(info: dict) -> None:
+    """Decide if a device can be booted with palera1n.
+
+    :param dict info: Device info, eligible and reason are set on it
+    """
+
+    mode = info['mode']
+    reason = None
+    try:
+        version = tuple(int(v) for v in info['version'].split('.')[:2]) if info.get('version') else None
+    except ValueError:
+        version = None
+
+    if info.get('error'):
+        reason = f'could not query device: {info["error"]}'
+    elif mode == 'diag':
+        reason = 'device is in diagnostics mode'
+    elif mode == 'checkra1n_stage2':
+        reason = 'device is busy with checkra1n'
+    elif info.get('arch') == 'arm64e':
+        reason = 'arm64e devices are not supported'
+    elif info.get('cpid') is not None and info.get('chip') is None:
+        reason = f'chip {info["cpid"]} is not supported'
+    elif info.get('cpid') is not None and int(info['cpid'], 16) not in SUPPORTED_CPIDS:
+        reason = f'{info["chip"]} ({info["cpid"]}) is not supported'
+    elif version is not None and not MIN_VERSION <= version <= MAX_VERSION:
+        reason = f'iOS {info["version"]} is not supported'
+    elif info.get('cpid') is None:
+        reason = 'could not identify chip'
+
+    info['eligible'] = reason is None
+    info['reason'] = reason
+
+
+def qualify(dev, mode: str, udids: dict) -> dict:
+    """Identify and classify a single device.
+
+    :param dev: USB device
+    :param str mode: Device mode
+    :param dict udids: usbmux UDIDs keyed by USB serial number
+    :return: Device info
+    :rtype: dict
+    """
+
+    info = {'port': utils.port_key(dev), 'mode': mode, 'product_type': None, 'cpid': None, 'chip': None, 'ecid': None,
+            'arch': None, 'version': None, 'firmware': None, 'error': None}
+
+    try:
+        if mode == 'normal':
+            udid = udids.get(dev.serial_number.replace('-', '').upper())
+            if udid is None:
+                raise ValueError('not visible to usbmuxd, is the device trusted?')
+            query_lockdown(udid, info)
+        elif mode in ('recovery', 'dfu', 'pongo'):
+            query_iboot(dev, info)
+    except Exception as err:
+        info['error'] = str(err) or type(err).__name__
+
+    classify(info)
+    return info
+
+
+def scan(max_workers: int = 16) -> list:
+    """Find every attached Apple device and check if it's eligible, in parallel.
+
+    :param int max_workers: Max devices queried at once (defaults to 16)
+    :return: Device info for each device, sorted by port
+    :rtype: list
+    """
+
+    devices = utils.find_devices()
+
+    if not devices:
+        return []
+
+    udids = {}
+    if any(mode == 'normal' for _, mode in devices):
+        try:
+            for mux in list_devices():
+                if mux.connection_type == 'USB':
+                    udids[mux.serial.replace('-', '').upper()] = mux.serial
+        except Exception:
+            pass
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+        results = list(pool.map(lambda d: qualify(d[0], d[1], udids), devices))
+
+    return sorted(results, key=lambda info: info['port'])
+
+
+def print_table(results: list) -> None:
+    """Print scan results as a table.
+
+    :param list results: Results from scan
+    """
+
+    if not results:
+        print('No devices found.')
+        return
+
+    print(f'{"PORT":<12}{"MODE":<18}{"DEVICE":<14}{"CHIP":<8}{"ECID":<20}{"IOS":<9}STATUS')
+    for info in results:
+        device = info['product_type'] or info['cpid'] or '?'
+        if info['eligible']:
+            status = colors['green'] + 'eligible' + colors['reset']
+        else:
+            status = colors['red'] + f'ineligible: {info["reason"]}' + colors['reset']
+        print(f'{info["port"]:<12}{info["mode"]:<18}{device:<14}{info["chip"] or "?":<8}{info["ecid"] or "?":<20}'
+              f'{info["version"] or "-":<9}{status}')
+
+    eligible = sum(1 for info in results if info['eligible'])
+    print(f'\n{eligible} of {len(results)} devices eligible')
+
+
+def to_json(results: list) -> str:
+    """Serialize scan results.
+
+    :param list results: Results from scan
+    :return: JSON
+    :rtype: str
+    """
+
+    return dumps(results, indent=4)
@@ -0,0 +1,310 @@
+# module imports
+from fcntl import LOCK_EX, LOCK_UN, flock
+from io import BytesIO
+from json import dump, load
+from os import getpid, replace
+from pathlib import Path
+from struct import pack
+from threading import Lock
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from typing import BinaryIO, Union
+from usb.core import USBError
+from usb.util import find_descriptor
+
+# local imports
+from . import utils
+from . import logger
+from .logger import colors
+
+
+# Chunk sizes we try, as multiples of the bulk endpoint's max packet size
+CHUNK_MULTIPLIERS = (64, 256, 1024, 4096, 16384)
+DEFAULT_MULTIPLIER = 1024
+DEFAULT_PACKET_SIZE = 512
+
+# Transfers smaller than this aren't used to score chunk sizes
+MIN_SAMPLE_SIZE = 1024 * 1024
+# Weight of the newest transfer in a chunk size's average throughput
+DECAY = 0.3
+# Every this many transfers on a port, a chunk size other than the best is re-measured
+EXPLORE_EVERY = 10
+
+# Serializes saves from tuners in different threads, upload.json.lock does the same across processes
+_save_lock = Lock()
+
+
+def max_packet_size(dev) -> int:
+    """Get the max packet size of Pongo's bulk OUT endpoint.
+
+    :param dev: USB device
+    :return: Max packet size, 512 if it can't be read
+    :rtype: int
+    """
+
+    try:
+        intf = dev.get_active_configuration()[(0, 0)]
+        ep = find_descriptor(intf, bEndpointAddress=0x02)
+        if ep is not None:
+            return ep.wMaxPacketSize
+    except (USBError, NotImplementedError, KeyError):
+        pass
+
+    return DEFAULT_PACKET_SIZE
+
+
+def candidates(packet_size: int) -> list:
+    """Get the chunk sizes to try for a given max packet size.
+
+    :param int packet_size: Max packet size of the endpoint
+    :return: Chunk sizes in bytes
+    :rtype: list
+    """
+
+    return [packet_size * m for m in CHUNK_MULTIPLIERS]
+
+
+class UploadTuner:
+    """Keeps track of measured upload throughput per USB port and chunk size.
+
+    Each chunk size keeps an exponentially weighted average of the throughput of
+    its transfers, so a single slow or fast sample doesn't decide it for good.
+    Transfers smaller than MIN_SAMPLE_SIZE are dominated by per-transfer latency
+    and aren't recorded. Every EXPLORE_EVERY transfers the chunk size measured
+    longest ago is tried again, so the choice follows a port that changed speed.
+    """
+
+    def __init__(self, data_dir: Union[Path, None], args=None) -> None:
+        self.path = Path(data_dir) / 'upload.json' if data_dir is not None else None
+        self.args = args
+        self.stats = self._load()
+        self._dirty = set()
+
+    @property
+    def debug(self) -> bool:
+        return bool(getattr(self.args, 'debug', False))
+
+    def _load(self) -> dict:
+        if self.path is None or not self.path.exists():
+            return {}
+
+        try:
+            with open(self.path, 'r') as f:
+                stats = load(f)
+        except (OSError, ValueError):
+            logger.debug(f'Could not read {self.path}, starting fresh', self.debug)
+            return {}
+
+        # Drop ports recorded in an older format
+        return {port: entry for port, entry in stats.items() if isinstance(entry, dict) and 'chunks' in entry}
+
+    def save(self) -> None:
+        """Write the measured stats to the data dir, unless the tuner isn't backed by a file.
+
+        The file is re-read first and only the ports this tuner recorded are
+        replaced, all while holding a lock on upload.json.lock, so tuners for
+        other devices, in this or another palera1n process, don't lose each
+        other's stats.
+        """
+
+        if self.path is None:
+            return
+
+        with _save_lock:
+            try:
+                lock = open(self.path.with_name(self.path.name + '.lock'), 'a')
+            except OSError as err:
+                logger.debug(f'Could not save upload stats: {err}', self.debug)
+                return
+
+            with lock:
+                flock(lock, LOCK_EX)
+                try:
+                    stats = self._load()
+                    stats.update({port: self.stats[port] for port in self._dirty})
+                    self.stats = stats
+
+                    tmp = self.path.with_name(f'{self.path.name}.{getpid()}.tmp')
+                    with open(tmp, 'w') as f:
+                        dump(stats, f, indent=4)
+                    replace(tmp, self.path)
+                except OSError as err:
+                    logger.debug(f'Could not save upload stats: {err}', self.debug)
+                finally:
+                    flock(lock, LOCK_UN)
+
+    def record(self, port: str, chunk_size: int, size: int, seconds: float) -> None:
+        """Record a finished transfer.
+
+        :param str port: Port key
+        :param int chunk_size: Chunk size that was used
+        :param int size: Bytes transferred
+        :param float seconds: Time the transfer took
+        """
+
+        if size < MIN_SAMPLE_SIZE or seconds <= 0:
+            return
+
+        stats = self.stats.setdefault(port, {'transfers': 0, 'chunks': {}})
+        stats['transfers'] += 1
+        self._dirty.add(port)
+
+        rate = size / seconds
+        entry = stats['chunks'].get(str(chunk_size))
+        if entry is None:
+            entry = stats['chunks'][str(chunk_size)] = {'rate': rate, 'samples': 0}
+        else:
+            entry['rate'] = DECAY * rate + (1 - DECAY) * entry['rate']
+        entry['samples'] += 1
+        entry['transfer'] = stats['transfers']
+
+    def throughput(self, port: str, chunk_size: int) -> Union[float, None]:
+        """Get the weighted average throughput measured for a chunk size.
+
+        :param str port: Port key
+        :param int chunk_size: Chunk size
+        :return: Bytes per second, None if never measured
+        :rtype: Union[float, None]
+        """
+
+        entry = self.stats.get(port, {}).get('chunks', {}).get(str(chunk_size))
+        if entry is None:
+            return None
+
+        return entry['rate']
+
+    def best(self, port: str, packet_size: int) -> Union[int, None]:
+        """Get the fastest measured chunk size on a port.
+
+        :param str port: Port key
+        :param int packet_size: Max packet size of the endpoint
+        :return: Chunk size, None if nothing was measured yet
+        :rtype: Union[int, None]
+        """
+
+        measured = [(self.throughput(port, c), c) for c in candidates(packet_size)]
+        measured = [m for m in measured if m[0] is not None]
+        if not measured:
+            return None
+
+        return max(measured)[1]
+
+    def choose(self, port: str, packet_size: int, size: int = None) -> int:
+        """Pick the chunk size for the next transfer.
+
+        Candidates that were never measured on this port are tried first,
+        after that the fastest one is used, except for every EXPLORE_EVERY-th
+        transfer which re-measures the candidate measured longest ago. Transfers
+        too small to be recorded just get the best known chunk size.
+
+        :param str port: Port key
+        :param int packet_size: Max packet size of the endpoint
+        :param int size: Bytes about to be transferred (defaults to None)
+        :return: Chunk size
+        :rtype: int
+        """
+
+        best = self.best(port, packet_size)
+        if size is not None and size < MIN_SAMPLE_SIZE:
+            return best if best is not None else packet_size * DEFAULT_MULTIPLIER
+
+        for chunk_size in candidates(packet_size):
+            if self.throughput(port, chunk_size) is None:
+                return chunk_size
+
+        stats = self.stats[port]
+        if (stats['transfers'] + 1) % EXPLORE_EVERY == 0:
+            others = [c for c in candidates(packet_size) if c != best]
+            if others:
+                return min(others, key=lambda c: stats['chunks'][str(c)].get('transfer', 0))
+
+        return best
+
+
+def send(dev, f: BinaryIO, size: int, chunk_size: int, timeout: int = 100000) -> float:
+    """Upload data to Pongo in chunks.
+
+    :param dev: USB device
+    :param BinaryIO f: File object to read from
+    :param int size: Amount of bytes to send
+    :param int chunk_size: Size of each bulk write
+    :param int timeout: Timeout for the whole transfer in ms (defaults to 100000)
+    :return: Time the bulk transfer took in seconds
+    :rtype: float
+    """
+
+    dev.ctrl_transfer(0x21, 2, 0, 0, 0)
+    dev.ctrl_transfer(0x21, 1, 0, 0, pack('I', size))
+
+    start = perf_counter()
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            raise EOFError(f'Expected {remaining} more bytes')
+
+        elapsed = int((perf_counter() - start) * 1000)
+        dev.write(2, data, max(timeout - elapsed, 1))
+        remaining -= len(data)
+
+    # Terminate the transfer with a zero length packet if it ended on a packet boundary
+    if utils.is_linux() and size % max_packet_size(dev) == 0:
+        dev.write(2, '')
+
+    return perf_counter() - start
+
+
+class SimulatedDevice:
+    """Stand-in for Pongo that models a bulk endpoint with a fixed
+    per-write overhead and bandwidth, used for benchmarking without hardware.
+    """
+
+    bus = 0
+    address = 0
+    port_numbers = (0,)
+
+    def __init__(self, bandwidth: float = 35e6, overhead: float = 0.0005, packet_size: int = DEFAULT_PACKET_SIZE) -> None:
+        self.bandwidth = bandwidth
+        self.overhead = overhead
+        self.packet_size = packet_size
+
+    def set_configuration(self) -> None:
+        pass
+
+    def get_active_configuration(self) -> dict:
+        return {(0, 0): [SimpleNamespace(bEndpointAddress=0x02, wMaxPacketSize=self.packet_size)]}
+
+    def ctrl_transfer(self, *args) -> int:
+        return 0
+
+    def write(self, endpoint: int, data, timeout: int = None) -> int:
+        sleep(self.overhead + len(data) / self.bandwidth)
+        return len(data)
+
+
+def benchmark(dev, tuner: UploadTuner, size: int = 16 * 1024 * 1024, rounds: int = 2) -> None:
+    """Measure upload throughput for every candidate chunk size and save the results.
+
+    :param dev: USB device (real or simulated)
+    :param UploadTuner tuner: Tuner to record the results in
+    :param int size: Bytes to send per round (defaults to 16 MiB)
+    :param int rounds: Rounds per chunk size (defaults to 2)
+    """
+
+    packet_size = max_packet_size(dev)
+    port = utils.port_key(dev)
+    payload = bytes(size)
+
+    dev.set_configuration()
+    logger.log(f'Benchmarking uploads on port {port} (max packet size {packet_size})')
+
+    for chunk_size in candidates(packet_size):
+        for _ in range(rounds):
+            seconds = send(dev, BytesIO(payload), size, chunk_size)
+            tuner.record(port, chunk_size, size, seconds)
+
+        print(f'{chunk_size // 1024:>8} KiB: {tuner.throughput(port, chunk_size) / 1e6:8.2f} MB/s')
+
+    tuner.save()
+    best = tuner.best(port, packet_size)
+    logger.log(f'Best chunk size for port {port}: {best // 1024} KiB', color=colors['green'], nln=False)
@@ -4,106 +4,38 @@ from importlib import resources
 from pathlib import Path
 from pkg_resources import get_distribution
 from platform import machine
+from platformdirs import PlatformDirs
 from pymobiledevice3.lockdown import LockdownClient
-from pymobiledevice3.irecv import IRecv
 from os import environ
-from re import match
+from re import findall, match
 from shutil import which
 from subprocess import getoutput, getstatusoutput
-from sys import platform, stdout, version_info
-from time import sleep
+from sys import platform, version_info
+from time import monotonic, sleep
 from typing import Union
+from usb.core import USBError, find
+from usb.util import dispose_resources
 
 # local imports
+from . import artifacts
 from . import logger
-from .logger import colors
+from .exceptions import CommandError, DeviceTimeoutError, MultipleDevicesError
 
 
-def __log_stdout(tolog: str):
-    stdout.write(tolog)
-    stdout.flush()
+# Device mode for each Apple USB product ID
+USB_MODES = {
+    '12a8': 'normal',
+    '12aa': 'normal',
+    '12ab': 'normal',
+    '1281': 'recovery',
+    '1227': 'dfu',
+    '1222': 'diag',
+    '1338': 'checkra1n_stage2',
+    '4141': 'pongo',
+}
 
-
-def __remove_log_stdout(toremove: str):
-    for _ in range(len(toremove)):
-        stdout.write('\033[D \033[D')
-        stdout.flush()
-
-
-def guide_to_dfu(cpid: str, product: str, irecv: IRecv):
-    """Guide the user to enter DFU mode
-
-    :param str cpid: CPID of the device
-    :param str product: Device product number
-    :param IRecv irecv: IRecv object to send the device into recovery
-    """
-    
-    log = 'Get ready (3)'
-    colorway = colors['yellow'] + colors['bold'] + '[*] ' + colors['reset'] + colors['yellow']
-
-    logger.ask('Press enter when you\'re ready to enter DFU mode.')
-    __log_stdout(colorway + log)
-    sleep(1)
-    __remove_log_stdout(colorway + log + colors['reset'])
-
-    for i in range(2):
-        i = i + 1
-        __remove_log_stdout(colorway + log.replace('3', str(3 - i)) + colors['reset'])
-        __log_stdout(colorway + log.replace('3', str(3 - i)) + colors['reset'])
-        sleep(1)
-    
-    __remove_log_stdout(colorway + log + logger.colors['reset'])
-
-    if (cpid.startswith('0x801') and product.startswith('iPad') is not True):
-        log = 'Hold volume down + side button (4)'
-    else:
-        log = 'Hold home + power button (4)'
-
-    __log_stdout(colorway + log + colors['reset'])
-    sleep(1)
-    __remove_log_stdout(colorway + log + colors['reset'])
-
-    for i in range(3):
-        i = i + 1
-        __remove_log_stdout(colorway + log.replace('4', str(4 - i)) + colors['reset'])
-        __log_stdout(colorway + log.replace('4', str(4 - i)) + colors['reset'])
-        if (i == 3):
-            try:
-                irecv.send_command('reset')
-            except:
-                pass
-        else:
-            sleep(1)
-
-    __remove_log_stdout(colorway + log + colors['reset'])
-
-    if (cpid.startswith('0x801') and product.startswith('iPad') is not True):
-        log = 'Release side button, but keep holding volume down (10)'
-    else:
-        log = 'Release power button, but keep holding home button (10)'
-    
-    __log_stdout(colorway + log + colors['reset'])
-    sleep(1)
-    __remove_log_stdout(colorway + log + colors['reset'])
-    
-    for i in range(9):
-        i = i + 1
-        if get_device_mode() == 'dfu':
-            __remove_log_stdout(colorway + log + colors['reset'])
-            logger.log('Successfully entered DFU mode.')
-            return
-        
-        __remove_log_stdout(colorway + log.replace('10', str(10 - i)) + colors['reset'])
-        __log_stdout(colorway + log.replace('10', str(10 - i)) + colors['reset'])
-        sleep(1)
-    
-    if get_device_mode() == 'dfu':
-        __remove_log_stdout(colorway + log + colors['reset'])
-        logger.log('Successfully entered DFU mode.')
-    else:
-        __remove_log_stdout(colorway + log + colors['reset'])
-        logger.error('Failed to enter DFU mode. Try running the script again.')
-        exit(1)
+# USB serial number of a device booted into an SSH ramdisk
+RAMDISK_SERIAL = '(ramdisk tool|SSHRD_Script) (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) [0-9]{1,2} [0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2}'
 
 
 def enter_recovery() -> None:
@@ -224,14 +156,116 @@ def get_resources_dir(package: str) -> Path:
     return res / 'data'
 
 
-def get_device_mode() -> str:
+def port_key(dev) -> str:
+    """Get a key identifying the USB port a device is attached to.
+
+    :param dev: USB device
+    :return: Key in the format bus-port.port...
+    :rtype: str
+    """
+
+    try:
+        ports = dev.port_numbers
+    except (USBError, NotImplementedError):
+        ports = None
+
+    if ports:
+        return f'{dev.bus}-{".".join(str(p) for p in ports)}'
+    else:
+        return f'{dev.bus}-addr{dev.address}'
+
+
+def parse_iboot_serial(serial: str) -> dict:
+    """Parse the USB serial number iBoot, SecureROM and Pongo report.
+
+    :param str serial: Serial number like 'CPID:8010 CPRV:11 ... ECID:001A2B... SRTG:[iBoot-2696.0.0.1.33]'
+    :return: Fields of the serial number
+    :rtype: dict
+    """
+
+    return {key: value.strip('[]') for key, value in findall(r'(\w+):(\[[^\]]*\]|\S+)', serial or '')}
+
+
+def usb_serial(dev) -> str:
+    """Get the USB serial number of a device.
+
+    :param dev: USB device
+    :return: Serial number, empty if it can't be read
+    :rtype: str
+    """
+
+    try:
+        return dev.serial_number or ''
+    except (USBError, ValueError, NotImplementedError):
+        return ''
+
+
+def matches_device(dev, selector: Union[str, None]) -> bool:
+    """Check if a device is the one a selector refers to.
+
+    A selector is either a port key (see port_key) or an ECID in hex. The ECID
+    is read from the USB serial number, so it only matches devices in recovery,
+    DFU or Pongo; use the port to select a device in normal mode.
+
+    :param dev: USB device
+    :param str selector: Port key or ECID, None matches every device
+    :return: True if the device matches
+    :rtype: bool
+    """
+
+    if selector is None or selector == port_key(dev):
+        return True
+
+    ecid = parse_iboot_serial(usb_serial(dev)).get('ECID')
+    try:
+        return ecid is not None and int(selector, 16) == int(ecid, 16)
+    except ValueError:
+        return False
+
+
+def find_devices(selector: str = None) -> list:
+    """Find attached Apple devices in a known mode.
+
+    :param str selector: Port key or ECID to limit the search to (defaults to None)
+    :return: (device, mode) tuples
+    :rtype: list
+    """
+
+    devices = []
+    for dev in find(find_all=True, idVendor=0x05ac):
+        mode = USB_MODES.get(f'{dev.idProduct:04x}')
+        if mode is not None and matches_device(dev, selector):
+            devices.append((dev, mode))
+
+    return devices
+
+
+def get_device_mode(selector: str = None) -> str:
     """
     Find what state the device is in
 
+    :param str selector: Port key or ECID of the device, required if more than one is attached (defaults to None)
     :return: Device state
     :rtype: str
+    :raises MultipleDevicesError: If more than one device is attached, or matches the selector
     """
     
+    if selector is not None:
+        devices = find_devices(selector)
+        if len(devices) >= 2:
+            raise MultipleDevicesError(f'More than one device matches {selector}')
+        if not devices:
+            return 'none'
+
+        dev, device_mode = devices[0]
+        try:
+            if match(RAMDISK_SERIAL, usb_serial(dev)):
+                device_mode = 'ramdisk'
+        finally:
+            dispose_resources(dev)
+
+        return device_mode
+    
     if is_macos():
         apples = getoutput("""system_profiler SPUSBDataType 2> /dev/null | grep -B1 'Vendor ID: 0x05ac' | grep 'Product ID:' | cut -dx -f2 | cut -d' ' -f1 | tail -r""")
     else:
@@ -241,70 +275,82 @@ def get_device_mode() -> str:
     usbserials = ''
     
     for apple in apples.splitlines():
-        if apple in ('12a8', '12aa', '12ab'):
-            device_mode = 'normal'
-            device_count += 1
-        elif apple == '1281':
-            device_mode = 'recovery'
-            device_count += 1
-        elif apple == '1227':
-            device_mode = 'dfu'
-            device_count += 1
-        elif apple == '1222':
-            device_mode = 'diag'
-            device_count += 1
-        elif apple == '1338':
-            device_mode = 'checkra1n_stage2'
-            device_count += 1
-        elif apple == '4141':
-            device_mode = 'pongo'
+        if apple in USB_MODES:
+            device_mode = USB_MODES[apple]
             device_count += 1
             
     if device_count == 0:
         device_mode = 'none'
     elif device_count >= 2:
-        logger.error('Please attach only one device')
-        exit(1)
+        raise MultipleDevicesError('Please attach only one device')
 
     if is_macos():
         usbserials = getoutput("""system_profiler SPUSBDataType 2> /dev/null | grep 'Serial Number' | cut -d: -f2- | sed 's/ //'""")
     else:
         usbserials = getoutput('cat /sys/bus/usb/devices/*/serial')
     
-    if match('(ramdisk tool|SSHRD_Script) (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) [0-9]{1,2} [0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2}', usbserials):
+    if match(RAMDISK_SERIAL, usbserials):
         device_mode = 'ramdisk'
     
     return device_mode
 
 
-def wait(mode: str, no_log: bool = False) -> bool:
+def wait(mode: str, no_log: bool = False, timeout: float = None, selector: str = None) -> bool:
     """Wait for device to go into a state.
     
     :param str mode: State we are waiting for
     :param bool no_log: Whether or not we should log
+    :param float timeout: Seconds to wait before giving up, None waits forever (defaults to None)
+    :param str selector: Port key or ECID of the device (defaults to None)
+    :raises DeviceTimeoutError: If the timeout passed
     """
     
-    if get_device_mode() != mode:
+    if get_device_mode(selector) != mode:
         if not no_log:
             logger.log(f'Waiting for device in {"DFU" if mode == "dfu" else mode} mode...')
     
-        while get_device_mode() != mode:
+        deadline = None if timeout is None else monotonic() + timeout
+        while get_device_mode(selector) != mode:
+            if deadline is not None and monotonic() >= deadline:
+                raise DeviceTimeoutError(f'Device did not enter {"DFU" if mode == "dfu" else mode} mode within {timeout:g} seconds')
             sleep(1)
 
 
+def reenumerate(selector: str = None) -> None:
+    """Reset the device, aborting pending transfers and making it re-enumerate.
+
+    Only Apple devices in one of the USB_MODES are considered, so other Apple
+    peripherals are left alone. Without a selector, nothing is reset unless
+    exactly one such device is attached.
+
+    :param str selector: Port key or ECID of the device (defaults to None)
+    """
+
+    devices = find_devices(selector)
+    if selector is None and len(devices) > 1:
+        return
+
+    for dev, _ in devices:
+        try:
+            dev.reset()
+        except USBError:
+            pass
+        dispose_resources(dev)
+
+
 def run(command: str, args: Namespace) -> None:
     """Run a command.
     
     :param str command: Command to run
     :param Namespace args: Args object
+    :raises CommandError: If the command failed
     """
     
     print(f'Running {command.split()[0]}')
     logger.debug(f'Running command: {command}', args.debug)
     status, output = getstatusoutput(command)
     if status != 0:
-        logger.error(f'An error occurred when running {command.split()[0]}: {output}')
-        exit(1)
+        raise CommandError(f'An error occurred when running {command.split()[0]}: {output}')
 
 
 def get_path(identity: dict, item: str) -> str:
@@ -326,6 +372,10 @@ def checkra1n_flags(args: Namespace) -> hex:
 def get_resource(name: str, in_package: bool) -> Path:
     """Get a resource from the directory.
     
+    Resources may be stored raw or as a compressed artifact (name.p1a), and
+    the directory in PALERA1N_ARTIFACTS is searched first if it's set.
+    Use artifacts.open_artifact to read either form.
+    
     :param str name: Name of the resource to retrieve
     :param bool in_package: If we are in a package
     :return: Path to the resources
@@ -333,6 +383,14 @@ def get_resource(name: str, in_package: bool) -> Path:
     """
     
     if in_package:
-        return get_resources_dir('palera1n') / name
+        data_dir = get_resources_dir('palera1n')
     else:
-        return Path('palera1n/data') / name
+        data_dir = Path('palera1n/data')
+    
+    artifacts_dir = environ.get('PALERA1N_ARTIFACTS')
+    for directory in ([Path(artifacts_dir)] if artifacts_dir else []) + [data_dir]:
+        path = artifacts.resolve(directory, name)
+        if path is not None:
+            return path
+    
+    return data_dir / name
@@ -0,0 +1,168 @@
+# module imports
+from argparse import ArgumentTypeError
+from contextlib import contextmanager
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Union
+from usb.core import USBTimeoutError
+
+# local imports
+from . import logger
+from .exceptions import DeviceTimeoutError, StageTimeoutError
+
+
+# Seconds each stage may take, None for no deadline
+DEADLINES = {
+    'detect': None,
+    'recovery': 60,
+    'dfu': 90,
+    'checkra1n': 120,
+    'pongo': 60,
+    'upload': 180,
+    'boot': 60,
+}
+
+
+def parse_deadline(value: str) -> tuple:
+    """Parse a stage=seconds deadline override from the command line.
+
+    :param str value: String like 'checkra1n=60', 0 disables the deadline
+    :return: Stage and seconds
+    :rtype: tuple
+    """
+
+    stage, _, seconds = value.partition('=')
+    try:
+        if stage not in DEADLINES:
+            raise ValueError
+        return stage, float(seconds) or None
+    except ValueError:
+        raise ArgumentTypeError(f'expected STAGE=SECONDS with STAGE one of {", ".join(DEADLINES)}')
+
+
+class Watchdog:
+    """Enforces per-stage deadlines.
+
+    Blocking calls are expected to take their own timeout from remaining().
+    When a stage goes past its deadline anyway, a supervising thread runs the
+    cancel callbacks registered for it (e.g. resetting the USB device) so the
+    stuck call returns, and the stage raises StageTimeoutError if that call
+    fails. Polling loops should stop when expired is set and call check().
+    """
+
+    def __init__(self, deadlines: dict = None, debug: bool = False) -> None:
+        self.deadlines = dict(DEADLINES, **(deadlines or {}))
+        self.debug = debug
+        self.stage_name = None
+        self.seconds = None
+        self.deadline = None
+        self.expired = False
+        self._callbacks = []
+        self._cond = Condition()
+        self._thread = None
+
+    def remaining(self) -> Union[float, None]:
+        """Get the seconds left in the current stage.
+
+        :return: Seconds left, None if the stage has no deadline
+        :rtype: Union[float, None]
+        """
+
+        with self._cond:
+            if self.deadline is None:
+                return None
+
+            return max(self.deadline - monotonic(), 0.001)
+
+    def restart(self) -> None:
+        """Start the deadline of the current stage over, e.g. after waiting for the operator."""
+
+        with self._cond:
+            self.expired = False
+            self.deadline = None if self.seconds is None else monotonic() + self.seconds
+            self._cond.notify()
+
+    def check(self) -> None:
+        """Raise if the current stage went past its deadline.
+
+        :raises StageTimeoutError: If the stage expired
+        """
+
+        if self.expired:
+            raise StageTimeoutError(self.stage_name, self.seconds)
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Register a callback that unblocks the current stage when it expires.
+
+        :param Callable callback: Function to call from the watchdog thread
+        """
+
+        with self._cond:
+            self._callbacks.append(callback)
+
+    def _supervise(self) -> None:
+        while True:
+            with self._cond:
+                while self.deadline is None or self.deadline > monotonic():
+                    self._cond.wait(None if self.deadline is None else self.deadline - monotonic())
+
+                self.expired = True
+                self.deadline = None
+                stage, callbacks, self._callbacks = self.stage_name, self._callbacks, []
+
+            logger.debug(f'Watchdog: {stage} expired, running {len(callbacks)} cancel callbacks', self.debug)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as err:
+                    logger.debug(f'Watchdog: cancel callback failed: {err}', self.debug)
+
+    def _end(self) -> bool:
+        with self._cond:
+            expired = self.expired
+            self.stage_name = None
+            self.seconds = None
+            self.deadline = None
+            self.expired = False
+            self._callbacks = []
+            self._cond.notify()
+
+        return expired
+
+    @contextmanager
+    def stage(self, name: str):
+        """Run a stage under its deadline.
+
+        :param str name: Name of the stage
+        :raises StageTimeoutError: If the stage went past its deadline
+        """
+
+        seconds = self.deadlines.get(name)
+        with self._cond:
+            self.stage_name = name
+            self.seconds = seconds
+            self.expired = False
+            self.deadline = None if seconds is None else monotonic() + seconds
+            self._cond.notify()
+
+        if seconds is not None and self._thread is None:
+            self._thread = Thread(target=self._supervise, daemon=True)
+            self._thread.start()
+
+        try:
+            yield
+        except (DeviceTimeoutError, USBTimeoutError) as err:
+            self._end()
+            if isinstance(err, StageTimeoutError):
+                raise
+            raise StageTimeoutError(name, seconds, str(err)) from err
+        except Exception as err:
+            if self._end():
+                raise StageTimeoutError(name, seconds, str(err)) from err
+            raise
+        except BaseException:
+            self._end()
+            raise
+
+        # A stage that finished is kept, even if it went past its deadline
+        self._end()